@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Compares bytes on the wire and end-to-end time per call for bulk orders
+sent uncompressed and gzip-compressed at several levels, against a local
+stand-in for the Spoke API running in a separate process.  The stand-in can
+simulate a constrained upload link.
+
+    python benchmarks/compression.py [calls] [cases per order] [upload bytes/s]
+
+"""
+
+import multiprocessing
+import random
+import sys
+import time
+
+import spoke
+from spoke.loadgen import random_order
+from spoke.testing import FauxSpokeServer
+
+
+def serve(pipe, bandwidth):
+    server = FauxSpokeServer()
+    server.compress_responses = True
+    server.bandwidth          = bandwidth
+    server.start()
+    pipe.send(server.url)
+    while pipe.recv() == 'bytes':
+        pipe.send(server.bytes_received)
+    server.stop()
+
+
+def main():
+    calls     = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    cases     = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    bandwidth = float(sys.argv[3]) if len(sys.argv) > 3 else 1000000
+
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(child, bandwidth))
+    server.start()
+    url = parent.recv()
+
+    try:
+        rng     = random.Random(0)
+        order   = random_order(rng, order_id=1)
+        order['Cases'] = [ dict(random_order(rng, max_cases=1)['Cases'][0], CaseId=n + 1) for n in range(cases) ]
+        sp      = spoke.Spoke(production=False, transport=spoke.Transport(url), Customer='bench', Key='bench')
+        request = sp._generate_request('New', order)
+        print('%d cases, %d bytes uncompressed, upload limited to %d bytes/s' % (cases, len(request), bandwidth))
+
+        for level in (None, 1, 6, 9):
+            if level is None:
+                transport = spoke.Transport(url)
+            else:
+                transport = spoke.Transport(url, compress_threshold=0, compress_level=level)
+            transport.send(request) # open the connection
+
+            parent.send('bytes')
+            before = parent.recv()
+            wall   = time.time()
+            for _ in range(calls):
+                transport.send(request)
+            elapsed = (time.time() - wall) / calls
+            parent.send('bytes')
+            sent = (parent.recv() - before) // calls
+
+            print('%-12s %8d bytes  %.3fms per call' % ('level %s' % level if level else 'uncompressed', sent, elapsed * 1000))
+    finally:
+        parent.send('stop')
+        server.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Compares the per-call cost of the requests-based Transport with
+HTTPClientTransport, against a local stand-in for the Spoke API running in
+a separate process (so that its CPU time isn't counted).
+
+    python benchmarks/transports.py [calls]
+
+"""
+
+import multiprocessing
+import sys
+import time
+
+import spoke
+from spoke.loadgen import process_time, random_order
+from spoke.testing import FauxSpokeServer
+
+
+def serve(pipe):
+    server = FauxSpokeServer().start()
+    pipe.send(server.url)
+    pipe.recv()
+    server.stop()
+
+
+def bench(transport, request, calls):
+    transport.send(request) # open the connection
+    wall = time.time()
+    cpu  = process_time()
+    for _ in range(calls):
+        transport.send(request)
+    return (time.time() - wall) / calls, (process_time() - cpu) / calls
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(child,))
+    server.start()
+    url = parent.recv()
+
+    try:
+        sp = spoke.Spoke(production=False, transport=spoke.Transport(url), Customer='bench', Key='bench')
+        request = sp._generate_request('New', random_order(order_id=1))
+
+        for transport_class in (spoke.Transport, spoke.HTTPClientTransport):
+            latency, cpu = bench(transport_class(url), request, calls)
+            print('%-20s latency %.3fms  cpu %.3fms per call' % (transport_class.__name__, latency * 1000, cpu * 1000))
+    finally:
+        parent.send('stop')
+        server.join()
+
+
+if __name__ == '__main__':
+    main()
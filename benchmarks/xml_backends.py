@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Compares the lxml and xml.etree backends: time to build and serialize a
+request, time to parse a response, peak memory while serializing, and the
+cold start cost of importing spoke with each.  Memory is as seen by
+tracemalloc, which doesn't count lxml's allocations in C.
+
+    python benchmarks/xml_backends.py [iterations]
+
+"""
+
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import spoke
+from spoke.loadgen import random_order
+
+RESPONSE = b'''<?xml version="1.0" encoding="utf-8" ?>
+<ResponseSuccess>
+  <result>Success</result>
+  <time>11/10/2011 03:50:28 -05:00</time>
+  <immc_id>12345</immc_id>
+</ResponseSuccess>'''
+
+
+def per_call(func, iterations):
+    start = time.time()
+    for _ in range(iterations):
+        func()
+    return (time.time() - start) / iterations
+
+
+def import_time(name):
+    env   = dict(os.environ, SPOKE_XML_BACKEND=name)
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c', 'import spoke'], env=env)
+    return time.time() - start
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    sp    = spoke.Spoke(production=False, transport=None, Customer='bench', Key='bench')
+    order = random_order(order_id=1, max_cases=5)
+
+    for name in sorted(spoke.XML_BACKENDS):
+        spoke.XML_BACKEND = spoke.xml_backend(name)
+        serialize = per_call(lambda: sp._generate_request('New', order), iterations)
+        parse     = per_call(lambda: sp._parse_response(RESPONSE), iterations)
+
+        tracemalloc.start()
+        sp._generate_request('New', order)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print('%-6s serialize %.1fus  parse %.1fus  peak %.1fKB  import %.0fms' % (
+            name, serialize * 1e6, parse * 1e6, peak / 1024.0, import_time(name) * 1000))
+
+
+if __name__ == '__main__':
+    main()
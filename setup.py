@@ -3,8 +3,9 @@ from setuptools import setup, find_packages
 
 setup(
     name             = 'Python-Spoke',
-    version          = '1.0.31',
+    version          = '2.0.0',
     packages         = find_packages(),
+    package_data     = {'spoke': ['products.csv', 'request.xsd']},
     description      = 'API bindings for Spoke API',
     long_description = open(os.path.join(os.path.dirname(__file__), 'README.md'), 'r').read(),
     license          = 'MIT',
@@ -12,6 +13,9 @@ setup(
     author_email     = 'rob.hoelz@skinnycorp.com',
     url              = 'https://github.com/Threadless/python-spoke',
     keywords         = 'spoke',
-    install_requires = ['lxml==4.9.3', 'requests==2.27.0'],
+    python_requires  = '>=3.6',
+    install_requires = ['requests==2.27.0'],
+    extras_require   = {'lxml': ['lxml==4.9.3']},
+    entry_points     = {'console_scripts': ['spoke-agent = spoke.agent:main']},
     tests_require    = ['nose==1.3.7', 'rednose==1.3.0'],
 )
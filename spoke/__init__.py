@@ -3,15 +3,31 @@
     the included README for a higher level overview.
 '''
 
+import collections
+import csv
+import datetime
+import decimal
+import hashlib
+import os
+import random
 import re
+import select
+import shelve
+import socket
+import threading
+import time
+import xml.etree.ElementTree
+import zlib
 
-from lxml import etree
 import requests
+import requests.adapters
 import six
+from six.moves import http_client
+from six.moves.urllib import parse as urlparse
 
-__version__ = '1.0.31'
+__version__ = '2.0.0'
 
-__all__ = ['Case', 'Comment', 'Image', 'OrderInfo', 'PackSlipCustomInfo', 'Spoke', 'ValidationError', 'SpokeError']
+__all__ = ['Case', 'Comment', 'DiskUpdateCache', 'FormatterRegistry', 'HTTPClientTransport', 'Image', 'Model', 'OrderInfo', 'OrderTemplate', 'PackSlipCustomInfo', 'ProductCatalog', 'Spoke', 'UpdateCache', 'ValidationError', 'SpokeError']
 
 # Validation code
 
@@ -37,6 +53,8 @@ class Validator(object):
             t = inner
             def type_validator(value):
                 if isinstance(value, t):
+                    if isinstance(value, Model):
+                        return value.validate()
                     return value
                 return t(**value)
             # XXX func name?
@@ -130,249 +148,377 @@ def _validate(d, **validation_spec):
         raise ValidationError('Missing required parameter "%s"' % first_key)
 
 
+# The fraction of trusted (unvalidated) constructions that are validated
+# anyway.  Set this above zero in debug or staging environments to catch bad
+# data coming through the trusted path.
+TRUSTED_SAMPLE_RATE = 0.0
+
+def _sample_trusted():
+    return TRUSTED_SAMPLE_RATE > 0 and random.random() < TRUSTED_SAMPLE_RATE
+
+
 # Actual spoke classes
 
-class Image(object):
+class Field(object):
     '''
-        Represents an image resource.  Used for PrintImage, QcImage, Logo, and PackSlip.
+        A model attribute that runs its field's validator whenever it's
+        assigned.  Values live in the object's __dict__, which is what gets
+        serialized.
     '''
 
-    def __init__(self, **kwargs):
-        '''
-            Required parameters:
+    def __init__(self, name, validator):
+        self.name      = name
+        self.validator = validator
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        try:
+            return obj.__dict__[self.name]
+        except KeyError:
+            raise AttributeError(self.name)
+
+    def __set__(self, obj, value):
+        if self.validator.is_conditional:
+            value = self.validator(value, obj.__dict__)
+        else:
+            value = self.validator(value)
+        obj.__dict__[self.name] = value
 
-            ImageType - The type of image referenced (ex. jpg, png, etc)
-            Url       - The URL of the image referenced.
-        '''
-        _validate(kwargs,
-            ImageType = Required(),
-            Url       = Required(),
-        )
-        self.__dict__ = kwargs
+    def __delete__(self, obj):
+        if self.validator.is_required:
+            raise ValidationError('Missing required parameter "%s"' % self.name)
+        obj.__dict__.pop(self.name, None)
 
 
-class Comment(object):
+class ModelType(type):
     '''
-        Represents a comment.  Used for comments on Case objects.
+        Gives each model class a Field for each entry in its fields.
     '''
 
+    def __init__(cls, name, bases, namespace):
+        super(ModelType, cls).__init__(name, bases, namespace)
+        for field_name, validator in namespace.get('fields', {}).items():
+            setattr(cls, field_name, Field(field_name, validator))
+
+
+class Model(six.with_metaclass(ModelType, object)):
+    '''
+        Base class for the objects sent to the API.  Subclasses list their
+        parameters and validators in fields.
+
+        Assigning to a field validates just that field, so a valid object
+        stays valid as it's changed, and validating it again (as new and
+        update do) costs nothing.  Changing the contents of a list field in
+        place isn't checked.
+    '''
+    __slots__ = ('_valid',)
+
+    fields = {}
+
     def __init__(self, **kwargs):
-        '''
-            Required parameters:
+        _validate(kwargs, **self.fields)
+        self.__dict__ = kwargs
+        self._valid   = True
 
-            Type        - One of 'Printer', 'Packaging'
-            CommentText - The actual comment text
+    def __setattr__(self, name, value):
+        if not name.startswith('_') and name not in self.fields:
+            raise ValidationError('parameter "%s" not allowed' % name)
+        object.__setattr__(self, name, value)
+
+    @classmethod
+    def from_trusted(cls, d):
         '''
-        _validate(kwargs,
-            Type        = Required(Enum('Printer', 'Packaging')),
-            CommentText = Required(),
-        )
-        self.__dict__ = kwargs
+            Builds an object from data that has already been validated, skipping
+            validation entirely.  The data must already be in the shape that
+            validation would produce (ex. lists for array fields); nested
+            records may be objects or plain dictionaries, which serialize the
+            same way.  The object is checked once if it's later passed to a
+            call that validates.
+
+            A TRUSTED_SAMPLE_RATE fraction of calls is validated anyway.
+        '''
+        if _sample_trusted():
+            return cls(**d)
+        obj = cls.__new__(cls)
+        obj.__dict__ = dict(d)
+        obj._valid   = False
+        return obj
+
+    # without these, pickle would save the _valid slot as a second dict
+    # for every object and restore it through __setattr__
+    def __getstate__(self):
+        if getattr(self, '_valid', False):
+            return self.__dict__
+        return (self.__dict__, False)
+
+    def __setstate__(self, state):
+        valid = not isinstance(state, tuple)
+        if not valid:
+            state = state[0]
+        object.__setattr__(self, '__dict__', state)
+        object.__setattr__(self, '_valid', valid)
+
+    def validate(self):
+        '''
+            Validates the whole object, unless it's known to be valid already,
+            raising a ValidationError if it isn't.  Returns the object.
+        '''
+        if not getattr(self, '_valid', False):
+            d = dict(self.__dict__)
+            _validate(d, **self.fields)
+            self.__dict__ = d
+            self._valid   = True
+        return self
 
 
-class PackSlipCustomInfo(object):
+class Image(Model):
     '''
-        Represents custom information for a pack slip.
+        Represents an image resource.  Used for PrintImage, QcImage, Logo, and PackSlip.
+
+        Required parameters:
+
+        ImageType - The type of image referenced (ex. jpg, png, etc)
+        Url       - The URL of the image referenced.
     '''
+    fields = dict(
+        ImageType = Required(),
+        Url       = Required(),
+    )
 
-    def __init__(self, **kwargs):
-        '''
-            Optional parameters:
 
-            Text1
-            Text2
-            Text3
-            Text4
-            Text5
-            Text6
-        '''
-        _validate(kwargs,
-            Text1 = Optional(),
-            Text2 = Optional(),
-            Text3 = Optional(),
-            Text4 = Optional(),
-            Text5 = Optional(),
-            Text6 = Optional(),
-        )
-        self.__dict__ = kwargs
+class Comment(Model):
+    '''
+        Represents a comment.  Used for comments on Case objects.
 
+        Required parameters:
 
-class Prices(object):
+        Type        - One of 'Printer', 'Packaging'
+        CommentText - The actual comment text
     '''
-        Specifies pricing data.
+    fields = dict(
+        Type        = Required(Enum('Printer', 'Packaging')),
+        CommentText = Required(),
+    )
+
+
+class PackSlipCustomInfo(Model):
     '''
+        Represents custom information for a pack slip.
 
-    def __init__(self, **kwargs):
-        '''
-            Optional parameters:
+        Optional parameters:
 
-            DisplayOnPackingSlip - Whether or not to show prices on the packing slip
-            CurrencySymbol       - The symbol for the currency used
-            TaxCents             - The tax price, expressed in cents
-            ShippingCents        - The shipping price, expressed in cents
-            DiscountCents        - The discount price (if any), expressed in cents
-        '''
-        _validate(kwargs,
-            DisplayOnPackingSlip = Optional(Enum('Yes', 'No')),
-            CurrencySymbol       = Optional(),
-            TaxCents             = Optional(),
-            ShippingCents        = Optional(),
-            DiscountCents        = Optional(),
-        )
-        self.__dict__ = kwargs
+        Text1
+        Text2
+        Text3
+        Text4
+        Text5
+        Text6
+    '''
+    fields = dict(
+        Text1 = Optional(),
+        Text2 = Optional(),
+        Text3 = Optional(),
+        Text4 = Optional(),
+        Text5 = Optional(),
+        Text6 = Optional(),
+    )
 
 
-class OrderInfo(object):
+class Prices(Model):
+    '''
+        Specifies pricing data.
+
+        Optional parameters:
+
+        DisplayOnPackingSlip - Whether or not to show prices on the packing slip
+        CurrencySymbol       - The symbol for the currency used
+        TaxCents             - The tax price, expressed in cents
+        ShippingCents        - The shipping price, expressed in cents
+        DiscountCents        - The discount price (if any), expressed in cents
+    '''
+    fields = dict(
+        DisplayOnPackingSlip = Optional(Enum('Yes', 'No')),
+        CurrencySymbol       = Optional(),
+        TaxCents             = Optional(),
+        ShippingCents        = Optional(),
+        DiscountCents        = Optional(),
+    )
+
+
+class OrderInfo(Model):
     '''
         Specifies order information.
+
+        The following parameters are required:
+
+        FirstName
+        LastName
+        Address1
+        City
+        State - If the given country doesn't have states/provinces, send the city
+        PostalCode
+        CountryCode
+        OrderDate - May be a datetime.date or datetime.datetime object
+        PhoneNumber
+
+        The following parameters are optional:
+
+        Address2
+        PurchaseOrderNumber - internal PO number
+        GiftMessage
+        PackSlipCustomInfo - A PackSlipCustomInfo object
+        Prices - A Prices object
+        ShippingLabelReference1
+        ShippingLabelReference2
+    '''
+    fields = dict(
+        FirstName               = Required(),
+        LastName                = Required(),
+        Address1                = Required(),
+        Address2                = Optional(),
+        City                    = Required(),
+        State                   = Required(),
+        PostalCode              = Required(),
+        CountryCode             = Required(),
+        OrderDate               = Required(),
+        PhoneNumber             = Required(),
+        PurchaseOrderNumber     = Optional(),
+        GiftMessage             = Optional(),
+        PackSlipCustomInfo      = Optional(PackSlipCustomInfo),
+        Prices                  = Optional(Prices),
+        ShippingLabelReference1 = Optional(),
+        ShippingLabelReference2 = Optional(),
+    )
+
+
+Product = collections.namedtuple('Product', 'code category family description')
+
+PRODUCTS_PATH = os.path.join(os.path.dirname(__file__), 'products.csv')
+
+class ProductCatalog(object):
     '''
+        The products that may be ordered, by CaseType code, each with a
+        category (ex. case, mug), a family for cases (ex. slim, tough) and a
+        description.  Codes are interned, so all the Case objects validated
+        against a catalog share one string per code.
 
-    def __init__(self, **kwargs):
+            spoke.CATALOG.add('SP10900', category='case', family='slim')
+            spoke.CATALOG['SP10603'].family # 'tough'
+    '''
+
+    def __init__(self, products=()):
+        self._products = collections.OrderedDict()
+        for product in products:
+            self.add(*product)
+
+    @classmethod
+    def from_file(cls, path):
+        catalog = cls()
+        catalog.load(path)
+        return catalog
+
+    def load(self, path):
         '''
-            The following parameters are required:
+            Adds the products in the CSV file at path, which has code,
+            category, family and description columns, replacing any products
+            with the same codes.
+        '''
+        with open(path) as f:
+            for row in csv.DictReader(f):
+                self.add(**row)
+
+    def add(self, code, category='', family='', description=''):
+        '''
+            Adds a product, or replaces the one with the same code.
+        '''
+        code = six.moves.intern(str(code))
+        self._products[code] = Product(code, category, family, description)
+
+    def remove(self, code):
+        del self._products[code]
 
-            FirstName
-            LastName
-            Address1
-            City
-            State - If the given country doesn't have states/provinces, send the city
-            PostalCode
-            CountryCode
-            OrderDate - May be a datetime.datetime object
-            PhoneNumber
+    def get(self, code, default=None):
+        return self._products.get(code, default)
 
-            The following parameters are optional:
+    def __getitem__(self, code):
+        return self._products[code]
 
-            Address2
-            PurchaseOrderNumber - internal PO number
-            GiftMessage
-            PackSlipCustomInfo - A PackSlipCustomInfo object
-            Prices - A Prices object
-            ShippingLabelReference1
-            ShippingLabelReference2
+    def __contains__(self, code):
+        return code in self._products
+
+    def __iter__(self):
+        return iter(self._products)
+
+    def __len__(self):
+        return len(self._products)
+
+    def products(self):
         '''
-        _validate(kwargs,
-            FirstName               = Required(),
-            LastName                = Required(),
-            Address1                = Required(),
-            Address2                = Optional(),
-            City                    = Required(),
-            State                   = Required(),
-            PostalCode              = Required(),
-            CountryCode             = Required(),
-            OrderDate               = Required(),
-            PhoneNumber             = Required(),
-            PurchaseOrderNumber     = Optional(),
-            GiftMessage             = Optional(),
-            PackSlipCustomInfo      = Optional(PackSlipCustomInfo),
-            Prices                  = Optional(Prices),
-            ShippingLabelReference1 = Optional(),
-            ShippingLabelReference2 = Optional(),
+            Returns the products, in the order they were added.
+        '''
+        return list(self._products.values())
 
-        )
-        self.__dict__ = kwargs
+    def canonical(self, code):
+        '''
+            Returns the catalog's interned copy of code, raising a
+            ValidationError if there's no such product.
+        '''
+        product = self._products.get(code)
+        if product is None:
+            raise ValidationError('value "%s" not in catalog' % str(code))
+        return product.code
+
+
+class InCatalog(Validator):
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def __call__(self, value):
+        return self.catalog.canonical(value)
 
 
-class Case(object):
+# The products accepted for Case's CaseType, loaded from the bundled
+# products.csv; add to or override it at runtime
+CATALOG = ProductCatalog.from_file(PRODUCTS_PATH)
+
+# The bundled product codes, for compatibility; doesn't follow changes to
+# CATALOG
+CASE_TYPES = tuple(CATALOG)
+
+
+class Case(Model):
     '''
         A case represents a phone or tablet cover in the order.
-    '''
-    def __init__(self, **kwargs):
-        '''
-            The following parameters are required:
 
-            CaseId
-            CaseType
-            Quantity
-            PrintImage
+        The following parameters are required:
 
-            The following parameters are optional:
+        CaseId
+        CaseType   - A product code in CATALOG
+        Quantity
+        PrintImage
 
-            QcImage
-            Prices
-            CurrencySymbol
-            RetailCents
-            DiscountCents
-            Comments
-        '''
-        _validate(kwargs,
-            CaseId         = Required(),
-            CaseType       = Required(Enum(
-                'bb9900bt', 'bbz10tough', 'kindlefirebt',
-                # apple / iphone
-                'iph3bt', 'iph3tough', 'iph4bt', 'iph4tough', 'iph4tough2', 
-                'ipt4gbt',  'iph5bt', 'iph5vibe', 'iph5cbt', 'ipt5gbt', 
-                'iph5xtreme', 'iph6bt', 'iph6tough', 'iph655bt', 'iph655tough',
-                'ipad4bt', 'ipadminitough', 'iph6sbtpresale', 
-                'iph6stoughpresale', 'iph6splusbtpresale', 
-                'iph6splustoughpresale', 'iph7bt', 'iph7tough', 'iph7plusbt',
-                'iph7plustough', 'iph8bt', 'iph8tough', 'iph10bt', 
-                'iph10tough', 'iphxsmaxbt', 'iphxsmaxtough', 'iphxrbt', 
-                'iphxrtough', 'iph11bt', 'iph11tough', 'iph11probt', 
-                'iph11protough', 'iph11promaxbt', 'iph11promaxtough',
-                'iph12minibt', 'iph12minitough', 'iph12probt',
-                'iph12protough', 'iph12promaxbt', 'iph12promaxtough',
-                'iph13bt', 'iph13tough', 'iph13minibt', 'iph13minitough',
-                'iph13probt', 'iph13protough', 'iph13promaxbt', 'iph13promaxtough',
-                'iph14snapps', 'iph14prosnapps', 'iph14plussnapps', 'iph14promaxsnapps',
-                'iph14toughps', 'iph14protoughps', 'iph14plustoughps', 'iph14promaxtoughps',
-                'SP10599', # iphone 15 slim
-                'SP10603', # iphone 15 tough
-                'SP10601', # iphone 15 plus slim
-                'SP10605', # iphone 15 plus tough
-                'SP10600', # iphone 15 pro slim
-                'SP10604', # iphone 15 pro tough
-                'SP10602', # iphone 15 pro max slim
-                'SP10606', # iphone 15 pro max tough
-                'SP10625', # iphone 16 slim
-                'SP10629', # iphone 16 tough
-                'SP10627', # iphone 16 plus slim
-                'SP10631', # iphone 16 plus tough
-                'SP10626', # iphone 16 pro slim
-                'SP10630', # iphone 16 pro tough
-                'SP10628', # iphone 16 pro max slim
-                'SP10632', # iphone 16 pro max tough
-                'SP10803', # iphone 17 slim
-                'SP10815', # iphone 17 tough
-                'SP10812', # iphone 17 pro slim
-                'SP10824', # iphone 17 pro tough
-                'SP10809', # iphone 17 pro max slim
-                'SP10821', # iphone 17 pro max tough
-                'SP10806', # iphone 17 air slim
-                'SP10818', # iphone 17 air tough
-                # buttons
-                'button-round-125', 'button-round-225',
-                # samsung / galaxy
-                'ssgn2tough', 'ssgs3vibe', 'ssgs4bt', 'ssgs4vibe',
-                'ssgs5bt', 'ssgn4bt', 'ssgs6vibe', 'ssgs6bt', 'ssgs7bt', 'ssgs8bt',
-                # magnets
-                '3x3-magnet', '4x4-magnet', '6x6-magnet',
-                # mugs
-                'mug11oz', 'mug15oz', 'mug12ozlatte', 'mug15oztravel', 
-                # notebooks
-                'journal5x7blank', 'journal5x7ruled', 'spiral6x8ruled',  
-                # stickers
-                '2x2-white', '3x3-white', '4x4-white', '6x6-white',
-                '2x2-clear', '3x3-clear', '4x4-clear', '6x6-clear',
-                # socks
-                'sock-small', 'sock-medium', 'sock-large',
-                # face masks
-                'facemasksmall', 'facemasklarge',
-                # puzzles
-                '8x10-puzzle', '11x14-puzzle', '16x20-puzzle',
-                # mouse pad / desk mat
-                '9x7mousepad', 'smallmat', 'largemat', 'xlargemat',
-                )),
-            Quantity       = Required(),
-            PrintImage     = Required(Image),
-            QcImage        = Optional(Image),
-            Prices         = Optional(),
-            CurrencySymbol = Optional(),
-            RetailCents    = Optional(),
-            DiscountCents  = Optional(),
-            Comments       = Optional(Array(Comment)),
-        )
-        self.__dict__ = kwargs
+        The following parameters are optional:
+
+        QcImage
+        Prices
+        CurrencySymbol
+        RetailCents
+        DiscountCents
+        Comments
+    '''
+    fields = dict(
+        CaseId         = Required(),
+        CaseType       = Required(InCatalog(CATALOG)),
+        Quantity       = Required(),
+        PrintImage     = Required(Image),
+        QcImage        = Optional(Image),
+        Prices         = Optional(),
+        CurrencySymbol = Optional(),
+        RetailCents    = Optional(),
+        DiscountCents  = Optional(),
+        Comments       = Optional(Array(Comment)),
+    )
 
 
 class SpokeError(Exception):
@@ -394,20 +540,574 @@ ERROR_REGEX = [
 
 
 
+class UpdateCache(object):
+    '''
+        Remembers a fingerprint of the last OrderInfo sent for each OrderId,
+        along with the result Spoke returned for it.  Holds at most max_size
+        orders, forgetting the least recently used ones first.
+    '''
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock    = threading.Lock()
+
+    def get(self, order_id):
+        with self._lock:
+            entry = self._entries.pop(str(order_id), None)
+            if entry is not None:
+                self._entries[str(order_id)] = entry
+            return entry
+
+    def set(self, order_id, fingerprint, result):
+        with self._lock:
+            self._entries.pop(str(order_id), None)
+            self._entries[str(order_id)] = (fingerprint, result)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, order_id):
+        with self._lock:
+            self._entries.pop(str(order_id), None)
+
+
+class DiskUpdateCache(object):
+    '''
+        An UpdateCache kept in a dbm file at path, so that it survives restarts.
+        Nothing is held in memory.
+    '''
+
+    def __init__(self, path):
+        self._shelf = shelve.open(path)
+        self._lock  = threading.Lock()
+
+    def get(self, order_id):
+        with self._lock:
+            return self._shelf.get(str(order_id))
+
+    def set(self, order_id, fingerprint, result):
+        with self._lock:
+            self._shelf[str(order_id)] = (fingerprint, result)
+
+    def discard(self, order_id):
+        with self._lock:
+            self._shelf.pop(str(order_id), None)
+
+    def close(self):
+        with self._lock:
+            self._shelf.close()
+
+
+def gzip_compress(data, level=6):
+    '''
+        Returns data gzip-compressed at level (1 to 9).
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
 class Transport(object):
-    def __init__(self, url):
-        self.url = url
+    '''
+        Sends requests with a requests session, keeping up to pool_size
+        connections open.
+
+        compress_threshold - If given, request bodies of at least this many
+                             bytes are sent gzip-compressed; bulk orders
+                             compress very well
+        compress_level     - The gzip compression level, 1 (fastest) to 9
+
+        Compressed responses are always accepted, and decoded by requests.
+    '''
+
+    def __init__(self, url, pool_size=10, compress_threshold=None, compress_level=6):
+        self.url                = url
+        self.session            = requests.Session()
+        self.compress_threshold = compress_threshold
+        self.compress_level     = compress_level
+        self._keepalive         = None
+        self._mount(pool_size)
+
+    def _mount(self, pool_size):
+        old = getattr(self, 'adapter', None)
+        self.pool_size = pool_size
+        self.adapter   = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount(self.url, self.adapter)
+        if old is not None:
+            old.close() # its pooled connections would otherwise leak
 
     def send(self, request):
-        res = requests.post(self.url, data=request)
+        headers = None
+        if self.compress_threshold is not None and len(request) >= self.compress_threshold:
+            request = gzip_compress(request, self.compress_level)
+            headers = {'Content-Encoding': 'gzip'}
+        res = self.session.post(self.url, data=request, headers=headers)
         res.raise_for_status()
         return res.content
 
+    def warmup(self, n_connections=1, keepalive=None):
+        '''
+            Opens n_connections connections to the API ahead of time, paying
+            for DNS resolution, TCP connect and the TLS handshake up front.  The
+            connections are kept in the session's pool for later sends.
+
+            If keepalive is given, the pool is refreshed every keepalive seconds
+            so idle connections don't go cold.
+        '''
+        if n_connections > self.pool_size:
+            self._mount(n_connections)
+
+        held    = []
+        lock    = threading.Lock()
+        def open_one():
+            # streamed responses hold on to their connection until read
+            res = self.session.head(self.url, stream=True)
+            with lock:
+                held.append(res)
+
+        threads = [ threading.Thread(target=open_one) for _ in range(n_connections) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # release only once every connection is open, so that none of them
+        # is handed out twice
+        for res in held:
+            res.content
+
+        if keepalive is not None:
+            self._schedule_keepalive(n_connections, keepalive)
+
+        return len(held)
+
+    def _schedule_keepalive(self, n_connections, keepalive):
+        self.close()
+        def refresh():
+            try:
+                self.warmup(n_connections, keepalive)
+            except Exception:
+                self._schedule_keepalive(n_connections, keepalive)
+        self._keepalive = threading.Timer(keepalive, refresh)
+        self._keepalive.daemon = True
+        self._keepalive.start()
+
+    def close(self):
+        '''
+            Stops any keepalive refresh started by warmup.
+        '''
+        if self._keepalive is not None:
+            self._keepalive.cancel()
+            self._keepalive = None
+
+def _dropped(sock):
+    # an idle connection is readable only once the server has closed it
+    if sock is None:
+        return True
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        return bool(poller.poll(0))
+    return bool(select.select([sock], [], [], 0)[0])
+
+
+class HTTPClientTransport(object):
+    '''
+        A transport built directly on the standard library's http.client, for
+        lower per-call overhead than Transport.  Connections are persistent
+        and shared between threads through a small pool.
+    '''
+
+    def __init__(self, url, timeout=None):
+        parts = urlparse.urlsplit(url)
+
+        self.url     = url
+        self.timeout = timeout
+        self._host   = parts.netloc
+        self._path   = parts.path + ('?' + parts.query if parts.query else '')
+        self._lock   = threading.Lock()
+        self._idle   = []
+        if parts.scheme == 'https':
+            self._connection_class = http_client.HTTPSConnection
+        else:
+            self._connection_class = http_client.HTTPConnection
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection = self._idle.pop()
+            if not _dropped(connection.sock):
+                return connection, True
+            connection.close()
+        return self._connection_class(self._host, timeout=self.timeout), False
+
+    def _checkin(self, connection):
+        with self._lock:
+            self._idle.append(connection)
+
+    def send(self, request):
+        # the server may have closed an idle connection, so a call on a
+        # reused one is retried on a fresh one, but only when the request
+        # can't have been received: never after a timeout waiting for the
+        # response, since the order may have been submitted by then
+        while True:
+            connection, reused = self._checkout()
+            try:
+                connection.request('POST', self._path, request, {'Content-Type' : 'text/xml; charset=utf-8'})
+            except (http_client.HTTPException, socket.error):
+                connection.close()
+                if reused:
+                    continue
+                raise
+            try:
+                res  = connection.getresponse()
+                body = res.read()
+            except http_client.RemoteDisconnected:
+                connection.close()
+                if reused: # closed without a byte of response
+                    continue
+                raise
+            except (http_client.HTTPException, socket.error):
+                connection.close()
+                raise
+            if res.will_close:
+                connection.close()
+            else:
+                self._checkin(connection)
+            if res.status >= 400:
+                response = requests.Response()
+                response.status_code = res.status
+                response.reason      = res.reason
+                response.url         = self.url
+                raise requests.HTTPError('%d %s for url: %s' % (res.status, res.reason, self.url), response=response)
+            return body
+
+    def warmup(self, n_connections=1, keepalive=None):
+        '''
+            Opens n_connections connections ahead of time.  keepalive is
+            accepted for compatibility with Transport and ignored.
+        '''
+        for _ in range(n_connections):
+            connection = self._connection_class(self._host, timeout=self.timeout)
+            connection.connect()
+            self._checkin(connection)
+        return n_connections
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+# Spoke's codes for the ShippingMethod values new accepts
+SHIPPING_METHODS = dict(
+    FirstClass      = 'FC',
+    PriorityMail    = 'PM',
+    TrackedDelivery = 'TD',
+    SecondDay       = 'SD',
+    Overnight       = 'ON',
+)
+
 ARRAY_CHILDREN_NAMES = dict(
     Cases    = 'CaseInfo',
     Comments = 'Comment',
 )
 
+def _format_bool(value):
+    return 'Yes' if value else 'No'
+
+def _format_date(value):
+    return value.strftime('%m/%d/%Y')
+
+def _format_int(value):
+    return '%d' % value # int.__str__ would use an int subclass's __repr__
+
+def _format_decimal(value):
+    return '{0:f}'.format(value) # never exponent notation
+
+
+class FormatterRegistry(object):
+    '''
+        Converts leaf values to the text sent to Spoke, by type.  The
+        formatter for a type is the one registered for the nearest class in
+        its MRO, falling back to str; it's looked up once per type and cached.
+
+            spoke.FORMATTERS.register(Money, lambda m: str(m.cents))
+    '''
+
+    def __init__(self):
+        self._formatters = {}
+        self._cache      = {}
+
+    def register(self, cls, formatter):
+        '''
+            Formats instances of cls (and its subclasses) with formatter, a
+            function from a value to a string.
+        '''
+        self._formatters[cls] = formatter
+        self._cache.clear()
+
+    def registered(self):
+        '''
+            Returns the registered (class, formatter) pairs.
+        '''
+        return list(self._formatters.items())
+
+    def formatter(self, cls):
+        formatter = self._cache.get(cls)
+        if formatter is None:
+            formatter = str
+            for base in cls.__mro__:
+                if base in self._formatters:
+                    formatter = self._formatters[base]
+                    break
+            self._cache[cls] = formatter
+        return formatter
+
+    def format(self, value):
+        formatter = self._cache.get(type(value))
+        if formatter is None:
+            formatter = self.formatter(type(value))
+        return formatter(value)
+
+
+# The formatters used for leaf values in requests; register more at runtime
+FORMATTERS = FormatterRegistry()
+FORMATTERS.register(six.text_type, passthrough)
+FORMATTERS.register(str, passthrough)
+FORMATTERS.register(bool, _format_bool)
+FORMATTERS.register(int, _format_int)
+FORMATTERS.register(decimal.Decimal, _format_decimal)
+FORMATTERS.register(datetime.date, _format_date) # and datetimes
+
+class LxmlBackend(object):
+    '''
+        Builds and parses XML with lxml.
+    '''
+    name = 'lxml'
+
+    def __init__(self):
+        from lxml import etree
+        self.etree   = etree
+        self.Element = etree.Element
+
+    def tostring(self, element, pretty_print=False):
+        return self.etree.tostring(element, encoding='utf-8', pretty_print=pretty_print)
+
+    def fromstring(self, data):
+        return self.etree.fromstring(data)
+
+
+class ElementTreeBackend(object):
+    '''
+        Builds and parses XML with the standard library's xml.etree, for
+        installs without lxml.  Requests come out byte for byte the same as
+        with LxmlBackend.
+    '''
+    name = 'etree'
+
+    def __init__(self):
+        self.etree   = xml.etree.ElementTree
+        self.Element = self.etree.Element
+
+    def _indent(self, element, level):
+        # the layout of lxml's pretty_print
+        if len(element):
+            inner = '\n' + '  ' * (level + 1)
+            if not element.text or not element.text.strip():
+                element.text = inner
+            for child in element:
+                self._indent(child, level + 1)
+                child.tail = inner
+            child.tail = '\n' + '  ' * level
+
+    def tostring(self, element, pretty_print=False):
+        if pretty_print:
+            self._indent(element, 0)
+        data = self.etree.tostring(element, encoding='utf-8', short_empty_elements=False)
+        # lxml escapes carriage returns, which the XML parser would otherwise
+        # normalize away; whitespace we add never has any
+        data = data.replace(b'\r', b'&#13;')
+        return data + b'\n' if pretty_print else data
+
+    def fromstring(self, data):
+        return self.etree.fromstring(data)
+
+
+XML_BACKENDS = dict(
+    lxml  = LxmlBackend,
+    etree = ElementTreeBackend,
+)
+
+def xml_backend(name=None):
+    '''
+        Returns the XML backend called name (lxml or etree).  By default,
+        that's the one named by the SPOKE_XML_BACKEND environment variable,
+        or lxml if it's installed.
+    '''
+    name = name or os.environ.get('SPOKE_XML_BACKEND')
+    if name:
+        return XML_BACKENDS[name]()
+    try:
+        return LxmlBackend()
+    except ImportError:
+        return ElementTreeBackend()
+
+# The backend used to build requests and parse responses; may be replaced
+# (ex. spoke.XML_BACKEND = spoke.xml_backend('etree'))
+XML_BACKEND = xml_backend()
+
+SCHEMA_PATH = os.path.join(os.path.dirname(__file__), 'request.xsd')
+
+_schema      = None
+_schema_lock = threading.Lock()
+
+def _schema_etree():
+    # schemas need lxml, whichever backend builds requests
+    try:
+        return LxmlBackend().etree
+    except ImportError:
+        raise ImportError('checking requests needs lxml; install Python-Spoke[lxml]')
+
+def check_request(request):
+    '''
+        Checks a request tree against the bundled request schema, raising a
+        ValidationError if it doesn't conform.  The schema is compiled on
+        first use and cached for the life of the process.
+    '''
+    global _schema
+    etree = _schema_etree()
+    if not isinstance(request, etree._Element):
+        request = etree.fromstring(XML_BACKEND.tostring(request))
+    with _schema_lock:
+        if _schema is None:
+            _schema = etree.XMLSchema(etree.parse(SCHEMA_PATH))
+        if not _schema.validate(request):
+            raise ValidationError('request does not match schema: %s' % _schema.error_log.last_error.message)
+
+def _new_order_fields():
+    # built afresh for each use, since conditional validators keep state
+    return dict(
+        OrderId          = Required(), # XXX number
+        ShippingMethod   = RequiredOnlyIfNot(['ShippingAccount', 'ShippingMethodId'], Enum('FirstClass', 'PriorityMail', 'TrackedDelivery', 'SecondDay', 'Overnight')),
+        ShippingMethodId = RequiredOnlyIfNot(['ShippingMethod']),
+        ShippingAccount  = RequiredOnlyIfNot(['ShippingMethod']),
+        PackSlip         = Optional(Image),
+        Comments         = Optional(Array(Comment)),
+        OrderInfo        = Required(OrderInfo),
+        Cases            = Required(Array(Case)),
+    )
+
+
+class _Prebuilt(object):
+    # a subtree serialized ahead of time, copied into each request; built
+    # once for each XML backend, since XML_BACKEND may be replaced
+    def __init__(self, build):
+        self.build    = build
+        self.elements = {}
+
+    def copy(self):
+        element = self.elements.get(XML_BACKEND.name)
+        if element is None:
+            element = self.elements[XML_BACKEND.name] = self.build()
+        return element.__deepcopy__({}) # skips copy.deepcopy's dispatch
+
+
+class OrderTemplate(object):
+    '''
+        Defaults shared by many new orders, validated and serialized once.
+        Made with Spoke.template, which takes any of new's parameters other
+        than OrderId and Cases; OrderInfo may give defaults for some of its
+        parameters (ex. Prices, PackSlipCustomInfo).
+
+            template = sp.template(
+                ShippingAccount  = ...,
+                ShippingMethodId = ...,
+                PackSlip         = spoke.Image(...),
+                OrderInfo        = dict(Prices=spoke.Prices(DisplayOnPackingSlip='Yes')),
+            )
+            template.new(OrderId=..., OrderInfo=dict(FirstName=..., ...), Cases=[...])
+
+        Per-order parameters override the defaults.  The defaults are
+        captured when the template is made; later changes to the objects
+        passed in aren't seen.
+    '''
+
+    def __init__(self, client, **defaults):
+        order_info = defaults.pop('OrderInfo', None) or {}
+        if isinstance(order_info, Model):
+            order_info = order_info.__dict__
+
+        fields = _new_order_fields()
+        for name in ('OrderId', 'Cases', 'OrderInfo'):
+            fields.pop(name)
+        self.defaults   = self._validated(defaults, fields)
+        self.order_info = self._validated(order_info, OrderInfo.fields)
+        self.client     = client
+
+        serializers = client._serializers()
+        def prebuild(values):
+            built = {}
+            for name, value in values.items():
+                if isinstance(value, (Model, list)):
+                    built[name] = _Prebuilt(lambda name=name, value=value: client._generate_tree(name, serializers, value))
+                    built[name].copy() # build it now, for the current backend
+            return built
+        self._defaults_built   = prebuild(self.defaults)
+        self._order_info_built = prebuild(self.order_info)
+
+    def _validated(self, values, fields):
+        validated = {}
+        for name, value in values.items():
+            validator = fields.get(name)
+            if validator is None:
+                raise ValidationError('parameter "%s" not allowed' % name)
+            if validator.is_conditional:
+                validated[name] = validator(value, values)
+            else:
+                validated[name] = validator(value)
+        return validated
+
+    def new(self, **kwargs):
+        '''
+            Creates a new order from the template and kwargs, which take the
+            same parameters as Spoke.new.
+        '''
+        order_info = kwargs.get('OrderInfo') or {}
+        if isinstance(order_info, Model):
+            order_info = order_info.__dict__
+        info = dict(self.order_info)
+        info.update(order_info)
+
+        order = dict(self.defaults)
+        order.update(kwargs)
+        if kwargs.get('validate', True):
+            # the defaults are valid models by now, so only the per-order
+            # values cost anything to check
+            order['OrderInfo'] = OrderInfo(**info)
+        else:
+            order['OrderInfo'] = info
+        order = self.client._prepare_new(order)
+
+        # send the prebuilt defaults in place of the values they stand for
+        for name, built in self._defaults_built.items():
+            if name not in kwargs:
+                order[name] = built
+        info = dict(order['OrderInfo'].__dict__ if isinstance(order['OrderInfo'], Model) else order['OrderInfo'])
+        for name, built in self._order_info_built.items():
+            if name not in order_info:
+                info[name] = built
+        order['OrderInfo'] = info
+
+        return self.client._new_prepared(order)
+
+
+def _response_text(tree, tag):
+    for element in tree.iter(tag):
+        return element.text
+    raise SpokeError('response has no %s element' % tag)
+
 PRODUCTION_URL = 'https://api.spokecustom.com/order/submit'
 STAGING_URL    = 'https://api-staging.spokecustom.com/order/submit'
 
@@ -427,35 +1127,72 @@ class Spoke(object):
 
             The following fields are optional:
 
-            transport - A custom transport object.  Used mainly for testing and debugging; be warned, here be dragons
+            transport      - A custom transport object, or a transport class (ex. HTTPClientTransport)
+                             to create one for the API URL.  Used mainly for testing and debugging;
+                             be warned, here be dragons
+            prewarm        - Number of connections to open at startup; see warmup
+            keepalive      - Seconds between refreshes of the prewarmed connections; see warmup
+            check_requests - Whether to check each request against the bundled XML schema
+                             before sending it.  A request that fails raises a ValidationError
+                             without touching the network
+            update_cache   - An UpdateCache (or DiskUpdateCache).  When given, update
+                             skips the request if the OrderInfo matches the one last
+                             sent for the order, returning the earlier result
+            preflight      - An object whose check_order method is called with each new
+                             order before it is sent; see spoke.preflight.ImagePreflight
+            recorder       - A spoke.recorder.FlightRecorder, which keeps the last few
+                             calls for post-mortems
             Logo
         '''
         _validate(kwargs,
-            production = Required(),
-            transport  = Optional(),
-            Customer   = Required(),
-            Key        = Required(),
-            Logo       = Optional(Image),
+            production     = Required(),
+            transport      = Optional(),
+            prewarm        = Optional(),
+            keepalive      = Optional(),
+            check_requests = Optional(),
+            update_cache   = Optional(),
+            preflight      = Optional(),
+            recorder       = Optional(),
+            Customer       = Required(),
+            Key            = Required(),
+            Logo           = Optional(Image),
         )
+        if kwargs.get('check_requests'):
+            _schema_etree() # fail now rather than on the first request
         self.__dict__ = kwargs
         self.transport = self._create_transport()
+        if kwargs.get('prewarm'):
+            self.warmup(self.prewarm, kwargs.get('keepalive'))
 
     def _create_transport(self):
-        if hasattr(self, 'transport'):
-            return self.transport
+        transport = getattr(self, 'transport', Transport)
+        if not isinstance(transport, type):
+            return transport
         elif self.production:
-            return Transport(PRODUCTION_URL)
+            return transport(PRODUCTION_URL)
         else:
-            return Transport(STAGING_URL)
+            return transport(STAGING_URL)
+
+    def warmup(self, n_connections=1, keepalive=None):
+        '''
+            Opens n_connections pooled connections to the API before any
+            traffic arrives, so that the first requests don't pay for DNS,
+            TCP and TLS setup.  If keepalive is given, the connections are
+            refreshed every keepalive seconds.  Does nothing for transports
+            that don't support warming up.
+        '''
+        if hasattr(self.transport, 'warmup'):
+            return self.transport.warmup(n_connections, keepalive)
 
     def _generate_tree(self, tag_name, serializers, node):
+        Element = XML_BACKEND.Element
         if isinstance(node, list):
-            elements = etree.Element(tag_name)
+            elements = Element(tag_name)
             for child in node:
                 elements.append(self._generate_tree(ARRAY_CHILDREN_NAMES[tag_name], serializers, child))
             return elements
         elif isinstance(node, dict):
-            parent = etree.Element(tag_name)
+            parent = Element(tag_name)
 
             for tag_name, subtree in node.items():
                 parent.append(self._generate_tree(tag_name, serializers, subtree))
@@ -464,15 +1201,11 @@ class Spoke(object):
             serializer = serializers[type(node)]
             return serializer(tag_name, node)
         else:
-            element = etree.Element(tag_name)
-
-            if not isinstance(node, str):
-                node = str(node)
-            element.text = node
-
+            element = Element(tag_name)
+            element.text = FORMATTERS.format(node)
             return element
 
-    def _generate_request(self, RequestType, Order):
+    def _serializers(self):
         def serialize_it(tag_name, value):
             return self._generate_tree(tag_name, serializers, value.__dict__)
 
@@ -483,7 +1216,16 @@ class Spoke(object):
             Comment            : serialize_it,
             PackSlipCustomInfo : serialize_it,
             Prices             : serialize_it,
+            _Prebuilt          : lambda tag_name, value: value.copy(),
         }
+        return serializers
+
+    def _fingerprint(self, OrderInfo):
+        tree = self._generate_tree('OrderInfo', self._serializers(), OrderInfo)
+        return hashlib.sha1(XML_BACKEND.tostring(tree)).digest()
+
+    def _generate_request(self, RequestType, Order):
+        serializers = self._serializers()
 
         request = self._generate_tree('Request', serializers, dict(
             Customer    = self.Customer,
@@ -491,23 +1233,51 @@ class Spoke(object):
             Key         = self.Key,
             Order       = Order,
         ))
-        return etree.tostring(request, encoding='utf-8', pretty_print=True)
+        if getattr(self, 'check_requests', False):
+            check_request(request)
+        return XML_BACKEND.tostring(request, pretty_print=True)
 
     def _send_request(self, request):
-        res    = self.transport.send(request)
-        tree   = etree.fromstring(res.decode('utf-8'))
-        result = tree.xpath('//result')[0].text
+        return self._parse_response(self.transport.send(request))
+
+    def _parse_response(self, res):
+        if not isinstance(res, bytes):
+            res = res.encode('utf-8')
+        tree   = XML_BACKEND.fromstring(res)
+        result = _response_text(tree, 'result')
 
         if result == 'Success':
-            immc_id = int(tree.xpath('//immc_id')[0].text)
+            immc_id = int(_response_text(tree, 'immc_id'))
             return dict(immc_id = immc_id)
         else:
-            message = tree.xpath('//message')[0].text
+            message = _response_text(tree, 'message')
             for regex, exception_class in ERROR_REGEX:
                 if regex.match(message):
                     raise exception_class(message)
             raise SpokeError(message)
 
+    def _submit(self, RequestType, Order):
+        recorder = getattr(self, 'recorder', None)
+        if recorder is None:
+            return self._send_request(self._generate_request(RequestType, Order))
+
+        # the start time, then the end of each phase the call gets through
+        marks    = [time.time()]
+        request  = response = None
+        try:
+            request  = self._generate_request(RequestType, Order)
+            marks.append(time.time())
+            response = self.transport.send(request)
+            marks.append(time.time())
+            result   = self._parse_response(response)
+            marks.append(time.time())
+        except Exception as e:
+            marks.append(time.time())
+            recorder.record(RequestType, Order.get('OrderId'), marks, request, response, e)
+            raise
+        recorder.record(RequestType, Order.get('OrderId'), marks, request, response)
+        return result
+
     def new(self, **kwargs):
         '''
             Creates a new order.  If there is a problem creating the order,
@@ -530,34 +1300,42 @@ class Spoke(object):
 
             PackSlip - A PackSlip object
             Comments - A list of Comments objects
+
+            Passing validate=False skips validation for data that is known to
+            be good; see Model.from_trusted.
         '''
-        shipping_method_map = dict(
-            FirstClass      = 'FC',
-            PriorityMail    = 'PM',
-            TrackedDelivery = 'TD',
-            SecondDay       = 'SD',
-            Overnight       = 'ON',
-        )
-        _validate(kwargs,
-            OrderId          = Required(), # XXX number
-            ShippingMethod   = RequiredOnlyIfNot(['ShippingAccount', 'ShippingMethodId'], Enum('FirstClass', 'PriorityMail', 'TrackedDelivery', 'SecondDay', 'Overnight')),
-            ShippingMethodId = RequiredOnlyIfNot(['ShippingMethod']),
-            ShippingAccount  = RequiredOnlyIfNot(['ShippingMethod']),
-            PackSlip         = Optional(Image),
-            Comments         = Optional(Array(Comment)),
-            OrderInfo        = Required(OrderInfo),
-            Cases            = Required(Array(Case)),
-        )
-        if "ShippingMethod" in kwargs:
-            kwargs['ShippingMethod'] = shipping_method_map[ kwargs['ShippingMethod'] ]
-        # XXX OrderDate (date or datetime?)
+        return self._new_prepared(self._prepare_new(kwargs))
+
+    def _new_prepared(self, kwargs):
+        cache = getattr(self, 'update_cache', None)
+        try:
+            result = self._submit(
+                RequestType = 'New',
+                Order       = kwargs,
+            )
+        except Exception:
+            if cache is not None:
+                cache.discard(kwargs['OrderId'])
+            raise
+        if cache is not None:
+            cache.set(kwargs['OrderId'], self._fingerprint(kwargs['OrderInfo']), result)
+        return result
+
+    def template(self, **defaults):
+        '''
+            Returns an OrderTemplate with defaults for new orders.
+        '''
+        return OrderTemplate(self, **defaults)
 
-        request = self._generate_request(
-            RequestType = 'New',
-            Order       = kwargs,
-        )
 
-        return self._send_request(request)
+    def _prepare_new(self, kwargs):
+        if kwargs.pop('validate', True) or _sample_trusted():
+            _validate(kwargs, **_new_order_fields())
+        if getattr(self, 'preflight', None) is not None:
+            self.preflight.check_order(kwargs)
+        if "ShippingMethod" in kwargs:
+            kwargs['ShippingMethod'] = SHIPPING_METHODS[ kwargs['ShippingMethod'] ]
+        return kwargs
 
 
     def update(self, **kwargs):
@@ -571,18 +1349,45 @@ class Spoke(object):
 
             OrderId
             OrderInfo
-        '''
-        _validate(kwargs,
-            OrderId   = Required(), # XXX number
-            OrderInfo = Required(OrderInfo)
-        )
 
-        request = self._generate_request(
-            RequestType = 'Update',
-            Order       = kwargs,
-        )
+            Like new, accepts validate=False for data that is known to be good.
 
-        return self._send_request(request)
+            If the client has an update_cache and OrderInfo is unchanged since
+            it was last sent, no request is made and the earlier result is
+            returned.
+        '''
+        kwargs = self._prepare_update(kwargs)
+
+        cache = getattr(self, 'update_cache', None)
+        if cache is not None:
+            fingerprint = self._fingerprint(kwargs['OrderInfo'])
+            cached      = cache.get(kwargs['OrderId'])
+            if cached is not None and cached[0] == fingerprint:
+                return dict(cached[1])
+
+        try:
+            result = self._submit(
+                RequestType = 'Update',
+                Order       = kwargs,
+            )
+        except Exception:
+            # Spoke may have applied it anyway, so the cached OrderInfo can
+            # no longer be trusted
+            if cache is not None:
+                cache.discard(kwargs['OrderId'])
+            raise
+        if cache is not None:
+            cache.set(kwargs['OrderId'], fingerprint, result)
+        return result
+
+
+    def _prepare_update(self, kwargs):
+        if kwargs.pop('validate', True) or _sample_trusted():
+            _validate(kwargs,
+                OrderId   = Required(), # XXX number
+                OrderInfo = Required(OrderInfo)
+            )
+        return kwargs
 
 
     def cancel(self, OrderId):
@@ -591,9 +1396,9 @@ class Spoke(object):
             raises a SpokeError.  Otherwise, returns a dictionary
             of the same form as the one returned by new.
         '''
-        request = self._generate_request(
+        if getattr(self, 'update_cache', None) is not None:
+            self.update_cache.discard(OrderId)
+        return self._submit(
             RequestType = 'Cancel',
             Order       = dict(OrderId = OrderId),
         )
-
-        return self._send_request(request)
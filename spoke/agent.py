@@ -0,0 +1,237 @@
+'''
+    spoke-agent: a long-running local daemon that keeps a warm Spoke client
+    (pooled, pre-opened connections) and submits orders on behalf of
+    short-lived producers, which talk to it over a Unix socket.
+
+        spoke-agent --socket /run/spoke.sock --customer ... --key ... --production
+
+    The protocol is a sequence of frames in each direction, each a 4-byte
+    big-endian length followed by that many bytes of UTF-8 JSON.  Requests
+    look like
+
+        {"op": "new", "args": {"OrderId": ..., ...}}
+
+    with op one of new, update or cancel, and args the keyword arguments for
+    the Spoke method.  Responses are either {"ok": true, "result": {...}} or
+    {"ok": false, "type": "SpokeError", "error": "message"}.  A connection may
+    carry any number of requests; separate connections are served
+    concurrently.  AgentClient speaks the protocol from Python.
+'''
+
+import argparse
+import errno
+import json
+import os
+import socket
+import stat
+import struct
+import threading
+
+from six.moves import socketserver
+
+import spoke
+
+__all__ = ['Agent', 'AgentClient', 'AgentError']
+
+FRAME     = struct.Struct('>I')
+MAX_FRAME = 16 * 1024 * 1024
+
+OPERATIONS = ('new', 'update', 'cancel')
+
+# exceptions that are recreated on the client side
+EXCEPTIONS = dict( (cls.__name__, cls) for cls in (spoke.ValidationError, spoke.SpokeError, spoke.SpokeDuplicateOrder) )
+
+
+class AgentError(spoke.SpokeError):
+    '''
+        Represents a failure in the agent other than a Spoke or validation error.
+    '''
+
+
+def _recv_exactly(sock, n):
+    chunks = []
+    while n:
+        chunk = sock.recv(n)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+
+def read_frame(sock):
+    '''
+        Reads one frame from sock and decodes it; returns None at end of stream.
+    '''
+    header = _recv_exactly(sock, FRAME.size)
+    if header is None:
+        return None
+    (length,) = FRAME.unpack(header)
+    if length > MAX_FRAME:
+        raise ValueError('frame of %d bytes is too large' % length)
+    body = _recv_exactly(sock, length)
+    if body is None:
+        return None
+    return json.loads(body.decode('utf-8'))
+
+
+def write_frame(sock, message):
+    body = json.dumps(message).encode('utf-8')
+    sock.sendall(FRAME.pack(len(body)) + body)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        agent = self.server.agent
+        while True:
+            try:
+                message = read_frame(self.request)
+            except ValueError as e:
+                write_frame(self.request, dict(ok=False, type='AgentError', error=str(e)))
+                return
+            if message is None:
+                return
+            write_frame(self.request, agent.handle(message))
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Agent(object):
+    '''
+        Serves client (a Spoke object) on the Unix socket at path, running at
+        most max_concurrency Spoke calls at once.
+    '''
+
+    def __init__(self, client, path, max_concurrency=16):
+        self.client  = client
+        self.path    = path
+        self._slots  = threading.BoundedSemaphore(max_concurrency)
+        self._server = None
+
+    def handle(self, message):
+        '''
+            Carries out one decoded request, returning the response.
+        '''
+        op = message.get('op') if isinstance(message, dict) else None
+        if op not in OPERATIONS:
+            return dict(ok=False, type='AgentError', error='unknown op %r' % (op,))
+        args = message.get('args') or {}
+
+        with self._slots:
+            try:
+                if op == 'cancel':
+                    result = self.client.cancel(args['OrderId'])
+                else:
+                    result = getattr(self.client, op)(**args)
+            except Exception as e:
+                return dict(ok=False, type=type(e).__name__, error=str(e))
+        return dict(ok=True, result=result)
+
+    def start(self):
+        '''
+            Starts serving in a background thread.
+        '''
+        try:
+            mode = os.stat(self.path).st_mode
+        except OSError:
+            pass
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise OSError(errno.EEXIST, "exists and isn't a socket", self.path)
+            os.unlink(self.path) # left over from an earlier run
+        self._server = _Server(self.path, _Handler)
+        self._server.agent = self
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def serve_forever(self):
+        self.start()
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            os.unlink(self.path)
+
+
+class AgentClient(object):
+    '''
+        Submits orders through a spoke-agent, with the same methods as Spoke.
+        Errors raised by Spoke in the agent are raised here as the same
+        exception class.
+    '''
+
+    def __init__(self, path, timeout=None):
+        self.path    = path
+        self.timeout = timeout
+        self._sock   = None
+
+    def _call(self, op, args):
+        if self._sock is None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.settimeout(self.timeout)
+            self._sock.connect(self.path)
+        try:
+            write_frame(self._sock, dict(op=op, args=args))
+            response = read_frame(self._sock)
+        except Exception:
+            self.close()
+            raise
+        if response is None:
+            self.close()
+            raise AgentError('agent closed the connection')
+        if response['ok']:
+            return response['result']
+        raise EXCEPTIONS.get(response['type'], AgentError)(response['error'])
+
+    def new(self, **kwargs):
+        return self._call('new', kwargs)
+
+    def update(self, **kwargs):
+        return self._call('update', kwargs)
+
+    def cancel(self, OrderId):
+        return self._call('cancel', dict(OrderId=OrderId))
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Submit orders to Spoke on behalf of local producers.')
+    parser.add_argument('--socket', default='/tmp/spoke-agent.sock', help='the Unix socket to listen on')
+    parser.add_argument('--customer', default=os.environ.get('SPOKE_CUSTOMER'), help='defaults to $SPOKE_CUSTOMER')
+    parser.add_argument('--key', default=os.environ.get('SPOKE_KEY'), help='defaults to $SPOKE_KEY, which unlike --key other users can\'t see with ps')
+    parser.add_argument('--production', action='store_true', help='use the production API')
+    parser.add_argument('--concurrency', type=int, default=16, help='the most orders to submit at once')
+    parser.add_argument('--keepalive', type=float, default=300, help='seconds between connection refreshes')
+    args = parser.parse_args(argv)
+
+    if not args.customer or not args.key:
+        parser.error('a customer and key are required')
+
+    client = spoke.Spoke(
+        production = args.production,
+        Customer   = args.customer,
+        Key        = args.key,
+        prewarm    = args.concurrency,
+        keepalive  = args.keepalive,
+    )
+    Agent(client, args.socket, args.concurrency).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+'''
+    A circuit breaker, so that during a Spoke outage workers fail fast
+    instead of each waiting out its timeouts, and Spoke isn't hit by the
+    whole backlog at once when it comes back.
+
+        breaker   = CircuitBreaker(failure_rate=0.5, slow_call=10, reset_timeout=30)
+        transport = BreakerTransport(spoke.Transport(spoke.PRODUCTION_URL), breaker, spool=save_for_later)
+        sp = spoke.Spoke(..., transport=transport)
+
+    The breaker starts closed, letting calls through.  When at least
+    failure_rate of the last window calls failed (timed out, couldn't
+    connect, got a 5xx or took longer than slow_call seconds), it opens and
+    rejects calls with CircuitOpen.  After reset_timeout seconds it goes
+    half-open and lets probes calls through; if they all succeed it closes,
+    and if any fails it opens again.  Other calls are rejected while probes
+    are in flight.
+
+    BreakerTransport passes rejected requests to spool, if given, and then
+    raises Spooled, so workers can move on to their next job.
+'''
+
+import threading
+import time
+
+import spoke
+from spoke.concurrency import OVERLOAD, classify
+
+__all__ = ['BreakerTransport', 'CircuitBreaker', 'CircuitOpen', 'Spooled', 'CLOSED', 'OPEN', 'HALF_OPEN']
+
+# states
+CLOSED    = 'closed'
+OPEN      = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpen(spoke.SpokeError):
+    '''
+        Raised instead of making a call while the circuit is open.
+    '''
+
+
+class Spooled(CircuitOpen):
+    '''
+        Raised once a rejected request has been handed to the spool.
+    '''
+
+
+class CircuitBreaker(object):
+    '''
+        Tracks the outcomes of calls and decides whether to allow more.
+
+        failure_rate  - The fraction of failed calls that opens the circuit
+        window        - The number of recent calls the failure rate is
+                        measured over
+        min_calls     - The fewest calls in the window before it can open
+        slow_call     - If given, calls slower than this many seconds count
+                        as failures
+        reset_timeout - Seconds the circuit stays open before probing
+        probes        - The number of calls let through while half-open, all
+                        of which must succeed to close the circuit
+        on_change     - Called with the old and new states on every change
+    '''
+
+    def __init__(self, failure_rate=0.5, window=20, min_calls=10, slow_call=None, reset_timeout=30, probes=1, on_change=None, clock=time.time):
+        self.failure_rate  = failure_rate
+        self.window        = window
+        self.min_calls     = min_calls
+        self.slow_call     = slow_call
+        self.reset_timeout = reset_timeout
+        self.probes        = probes
+        self.on_change     = on_change
+        self.clock         = clock
+        self._state        = CLOSED
+        self._opened_at    = None
+        self._outcomes     = bytearray(window)
+        self._calls        = 0
+        self._failed       = 0
+        self._probing      = 0
+        self._probed       = 0
+        self._condition    = threading.Condition()
+
+    @property
+    def state(self):
+        with self._condition:
+            return self._current_state()
+
+    def _current_state(self):
+        if self._state == OPEN and self.clock() - self._opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return self._state
+
+    def _change(self, state):
+        # called with the lock held; returns the change to report
+        old = self._state
+        self._state = state
+        if state == OPEN:
+            self._opened_at = self.clock()
+        elif state == HALF_OPEN:
+            self._probing = self._probed = 0
+        else:
+            self._outcomes[:] = bytearray(self.window)
+            self._calls = self._failed = 0
+        self._condition.notify_all()
+        return (old, state)
+
+    def _report(self, change):
+        if change is not None and self.on_change is not None:
+            self.on_change(*change)
+
+    def _admit(self):
+        '''
+            Returns the state a call is admitted under, or None if it's
+            rejected.
+        '''
+        change = None
+        with self._condition:
+            if self._current_state() == HALF_OPEN and self._state == OPEN:
+                change = self._change(HALF_OPEN)
+            state = self._state
+            if state == OPEN or (state == HALF_OPEN and self._probing >= self.probes - self._probed):
+                state = None
+            elif state == HALF_OPEN:
+                self._probing += 1
+        self._report(change)
+        return state
+
+    def _record(self, admitted, elapsed, failed):
+        if self.slow_call is not None and elapsed > self.slow_call:
+            failed = True
+
+        change = None
+        with self._condition:
+            if admitted != self._state:
+                pass # decided under a state that's since changed
+            elif admitted == HALF_OPEN:
+                self._probing -= 1
+                if failed:
+                    change = self._change(OPEN)
+                else:
+                    self._probed += 1
+                    if self._probed >= self.probes:
+                        change = self._change(CLOSED)
+            else:
+                n = self._calls % self.window
+                self._failed += failed - self._outcomes[n]
+                self._outcomes[n] = failed
+                self._calls += 1
+                seen = min(self._calls, self.window)
+                if seen >= self.min_calls and self._failed >= self.failure_rate * seen:
+                    change = self._change(OPEN)
+        self._report(change)
+
+    def call(self, func, *args, **kwargs):
+        '''
+            Calls func through the breaker, raising CircuitOpen if the circuit
+            doesn't allow it.
+        '''
+        admitted = self._admit()
+        if admitted is None:
+            raise CircuitOpen('circuit open; call rejected')
+
+        started = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self._record(admitted, time.time() - started, classify(e) == OVERLOAD)
+            raise
+        self._record(admitted, time.time() - started, False)
+        return result
+
+    def _ready(self):
+        if self._state == OPEN:
+            return self._current_state() == HALF_OPEN # probing starts afresh
+        return self._state == CLOSED or self._probing < self.probes - self._probed
+
+    def wait(self, timeout=None):
+        '''
+            Blocks until the breaker would let a call through (it's closed, or
+            a probe may be sent), or for at most timeout seconds; returns
+            whether it would.  Lets workers idle through an outage instead of
+            collecting CircuitOpen errors.
+        '''
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._condition:
+            while not self._ready():
+                waits = []
+                if deadline is not None:
+                    waits.append(deadline - time.time())
+                if self._state == OPEN:
+                    waits.append(self._opened_at + self.reset_timeout - self.clock())
+                remaining = min(waits) if waits else None
+                if deadline is not None and deadline - time.time() <= 0:
+                    return False
+                self._condition.wait(max(remaining, 0.001) if remaining is not None else None)
+            return True
+
+
+class BreakerTransport(object):
+    '''
+        Sends through inner, guarded by breaker.  Requests rejected by the
+        breaker are passed to spool, if given, before Spooled is raised.
+    '''
+
+    def __init__(self, inner, breaker=None, spool=None):
+        self.inner   = inner
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.spool   = spool
+
+    def send(self, request):
+        try:
+            return self.breaker.call(self.inner.send, request)
+        except CircuitOpen:
+            if self.spool is None:
+                raise
+            self.spool(request)
+            raise Spooled('circuit open; request spooled')
+
+    def warmup(self, n_connections=1, keepalive=None):
+        if hasattr(self.inner, 'warmup'):
+            return self.inner.warmup(n_connections, keepalive)
+
+    def close(self):
+        if hasattr(self.inner, 'close'):
+            self.inner.close()
@@ -0,0 +1,166 @@
+'''
+    Adaptive concurrency control for bulk submission.  An AIMDLimiter raises
+    the number of requests allowed in flight while Spoke keeps up, and cuts it
+    back when calls time out, fail with a server error or are rate limited
+    (additive increase, multiplicative decrease), so that throughput settles
+    near the best level without tuning a thread count by hand.
+
+        limiter = AIMDLimiter(initial=4, maximum=64, latency_target=2.0)
+        results = submit_all(client, orders, limiter)
+'''
+
+import re
+import socket
+import threading
+import time
+
+import requests
+
+import spoke
+
+__all__ = ['AIMDLimiter', 'OK', 'ERROR', 'OVERLOAD', 'classify', 'submit_all']
+
+# outcomes of a call
+OK       = 'ok'
+ERROR    = 'error'    # the call failed, but not because Spoke is struggling
+OVERLOAD = 'overload' # timeouts, 5xx and rate limiting
+
+RATE_LIMITED = re.compile(r'rate limit|too many requests', re.I)
+
+
+def classify(exc):
+    '''
+        Returns the outcome for a call that raised exc.
+    '''
+    if isinstance(exc, (requests.Timeout, socket.timeout)):
+        return OVERLOAD
+    if isinstance(exc, requests.HTTPError):
+        status = getattr(exc.response, 'status_code', None)
+        if status is not None and (status >= 500 or status == 429):
+            return OVERLOAD
+        return ERROR
+    if isinstance(exc, requests.ConnectionError):
+        return OVERLOAD
+    if isinstance(exc, spoke.SpokeError) and RATE_LIMITED.search(str(exc)):
+        return OVERLOAD
+    return ERROR
+
+
+class AIMDLimiter(object):
+    '''
+        Limits the number of calls in flight, adapting the limit to how Spoke
+        responds.
+
+        initial        - The starting limit
+        minimum        - The lowest the limit goes
+        maximum        - The highest the limit goes
+        increase       - How much the limit grows for each limit's worth of
+                         good calls
+        decrease       - The factor the limit is multiplied by on overload
+        latency_target - If given, calls slower than this many seconds count
+                         as overload
+        on_change      - Called with the new limit whenever it changes
+    '''
+
+    def __init__(self, initial=4, minimum=1, maximum=64, increase=1, decrease=0.5, latency_target=None, on_change=None):
+        self.minimum        = minimum
+        self.maximum        = maximum
+        self.increase       = increase
+        self.decrease       = decrease
+        self.latency_target = latency_target
+        self.on_change      = on_change
+        self.in_flight      = 0
+        self._limit         = float(initial)
+        self._last_decrease = 0
+        self._condition     = threading.Condition()
+
+    @property
+    def limit(self):
+        '''
+            The current limit on calls in flight.
+        '''
+        return int(self._limit)
+
+    def acquire(self):
+        '''
+            Blocks until a call may start; returns its start time, to be passed
+            to release.
+        '''
+        with self._condition:
+            while self.in_flight >= int(self._limit):
+                self._condition.wait()
+            self.in_flight += 1
+        return time.time()
+
+    def release(self, started, outcome=OK):
+        '''
+            Records the outcome of a call started at started.
+        '''
+        now     = time.time()
+        latency = now - started
+        if outcome == OK and self.latency_target is not None and latency > self.latency_target:
+            outcome = OVERLOAD
+
+        with self._condition:
+            self.in_flight -= 1
+            before = int(self._limit)
+            if outcome == OVERLOAD:
+                # calls that were already in flight when the limit was cut
+                # report the same congestion; only back off once for them
+                if started >= self._last_decrease:
+                    self._limit         = max(self.minimum, self._limit * self.decrease)
+                    self._last_decrease = now
+            elif outcome == OK:
+                self._limit = min(self.maximum, self._limit + float(self.increase) / max(1, int(self._limit)))
+            after = int(self._limit)
+            self._condition.notify_all()
+
+        if after != before and self.on_change is not None:
+            self.on_change(after)
+
+    def call(self, func, *args, **kwargs):
+        '''
+            Calls func under the limiter, recording how it went.
+        '''
+        started = self.acquire()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self.release(started, classify(e))
+            raise
+        self.release(started, OK)
+        return result
+
+
+def submit_all(client, orders, limiter=None, method='new'):
+    '''
+        Submits each of orders (keyword arguments for client.new, or for
+        method) through limiter, with as many threads as the limiter's
+        maximum.  Returns a list with each order's result, or the exception
+        it raised, in the same order as orders.
+    '''
+    if limiter is None:
+        limiter = AIMDLimiter()
+    orders  = list(orders)
+    results = [None] * len(orders)
+    lock    = threading.Lock()
+    pending = iter(range(len(orders)))
+    submit  = getattr(client, method)
+
+    def worker():
+        while True:
+            with lock:
+                n = next(pending, None)
+            if n is None:
+                return
+            try:
+                results[n] = limiter.call(submit, **orders[n])
+            except Exception as e:
+                results[n] = e
+
+    threads = [ threading.Thread(target=worker) for _ in range(min(limiter.maximum, len(orders))) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
@@ -0,0 +1,117 @@
+'''
+    Decoding of Spoke request XML (the output of Spoke._generate_request)
+    back into the keyword arguments and model objects it was made from, for
+    re-sending, migrating or analysing archived requests.
+
+        request = decode(body)
+        client.new(**request.Order)
+
+    iterdecode streams many requests out of one large document, such as an
+    archive wrapping each request in a common root element, clearing each
+    one as soon as it's decoded so memory use stays flat.
+
+        with open('requests.xml', 'rb') as f:
+            for request in iterdecode(f):
+                ...
+
+    Every leaf value comes back as a string, exactly as it was sent.
+'''
+
+import collections
+
+import spoke
+
+__all__ = ['DecodedRequest', 'decode', 'iterdecode']
+
+DecodedRequest = collections.namedtuple('DecodedRequest', 'RequestType Customer Key Order')
+
+# tags whose elements are model objects, wherever they appear
+MODELS = dict(
+    OrderInfo          = spoke.OrderInfo,
+    PackSlip           = spoke.Image,
+    PrintImage         = spoke.Image,
+    QcImage            = spoke.Image,
+    CaseInfo           = spoke.Case,
+    Comment            = spoke.Comment,
+    PackSlipCustomInfo = spoke.PackSlipCustomInfo,
+)
+
+# (parent tag, tag) pairs whose elements are model objects; a Case's Prices
+# is a plain dictionary
+NESTED_MODELS = {
+    ('OrderInfo', 'Prices') : spoke.Prices,
+}
+
+ARRAY_NAMES = frozenset(spoke.ARRAY_CHILDREN_NAMES)
+
+SHIPPING_METHOD_NAMES = dict( (code, name) for name, code in spoke.SHIPPING_METHODS.items() )
+
+
+def _decode_element(element, parent_tag, validate):
+    tag = element.tag
+    if tag in ARRAY_NAMES:
+        return [ _decode_element(child, tag, validate) for child in element ]
+
+    model = MODELS.get(tag) or NESTED_MODELS.get((parent_tag, tag))
+    if model is None and len(element) == 0:
+        return element.text or ''
+
+    fields = dict( (child.tag, _decode_element(child, tag, validate)) for child in element )
+    if model is None:
+        return fields
+    if validate:
+        return model(**fields)
+    return model.from_trusted(fields)
+
+
+def _decode_request(element, validate):
+    values = dict( (child.tag, child) for child in element )
+    order  = _decode_element(values['Order'], 'Request', validate)
+    if 'ShippingMethod' in order:
+        order['ShippingMethod'] = SHIPPING_METHOD_NAMES.get(order['ShippingMethod'], order['ShippingMethod'])
+    return DecodedRequest(
+        RequestType = values['RequestType'].text,
+        Customer    = values['Customer'].text,
+        Key         = values['Key'].text,
+        Order       = order,
+    )
+
+
+def decode(request, validate=False):
+    '''
+        Decodes one request (bytes) into a DecodedRequest, whose Order holds
+        the keyword arguments for the Spoke method named by its RequestType,
+        with ShippingMethod translated back to the name new accepts.
+
+        Models are built with Model.from_trusted unless validate is true.
+    '''
+    return _decode_request(spoke.XML_BACKEND.fromstring(request), validate)
+
+
+def iterdecode(source, validate=False, tag='Request'):
+    '''
+        Yields a DecodedRequest for each tag element in source, a file object
+        or path, parsing incrementally.
+    '''
+    backend = spoke.XML_BACKEND
+    if backend.name == 'lxml':
+        for _, element in backend.etree.iterparse(source, events=('end',), tag=tag):
+            yield _decode_request(element, validate)
+
+            # drop the element and anything before it that's still attached
+            element.clear()
+            parent = element.getparent()
+            if parent is not None:
+                while element.getprevious() is not None:
+                    del parent[0]
+    else:
+        # xml.etree has no tag filter or parent links; clear the root instead
+        root = None
+        for event, element in backend.etree.iterparse(source, events=('start', 'end')):
+            if root is None:
+                root = element
+            if event == 'end' and element.tag == tag:
+                yield _decode_request(element, validate)
+                element.clear()
+                if element is not root:
+                    root.clear()
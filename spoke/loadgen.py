@@ -0,0 +1,229 @@
+# vim: fileencoding=utf8
+
+'''
+    A load generator for measuring how many orders per second a host can push
+    through a Spoke client.  It builds synthetic orders and drives them through
+    any client (and so any transport) at a target rate or concurrency, then
+    reports throughput, latency percentiles, errors and CPU time per order.
+
+    From the command line, against a local stand-in for the API:
+
+        python -m spoke.loadgen --local --count 5000 --concurrency 16
+
+    The local stand-in runs in a separate process, so that its CPU time isn't
+    counted in cpu/order.
+'''
+
+import argparse
+import collections
+import datetime
+import multiprocessing
+import random
+import threading
+import time
+
+import spoke
+from spoke.testing import FauxSpokeServer
+
+__all__ = ['Report', 'random_order', 'run']
+
+process_time = time.process_time
+
+FIRST_NAMES = [u'Xavier', u'Björn', u'Zoë', u'Søren', u'Anaïs', u'Иван', u'美咲', u'José']
+LAST_NAMES  = [u'Ample', u'Björnsson', u'Nuñez', u'Øvergaard', u'Смирнов', u'山田', u'Dubois']
+STREETS     = [u'Fake St', u'поддельная улица', u'Rue de l’Église', u'Hauptstraße', u'中央通り']
+CITIES      = [(u'Chicago', u'IL', u'US'), (u'Санкт-Петербург', u'-', u'RU'), (u'München', u'BY', u'DE'),
+               (u'Montréal', u'QC', u'CA'), (u'東京', u'Tokyo', u'JP')]
+SHIPPING    = ['FirstClass', 'PriorityMail', 'TrackedDelivery', 'SecondDay', 'Overnight']
+
+
+def random_order(rng=random, order_id=None, max_cases=5):
+    '''
+        Returns the keyword arguments for a realistic Spoke.new call: a random
+        address (frequently non-ASCII), and between one and max_cases cases of
+        random CaseTypes.
+    '''
+    city, state, country = rng.choice(CITIES)
+    if order_id is None:
+        order_id = rng.randint(1000000, 9999999)
+
+    return dict(
+        OrderId        = order_id,
+        ShippingMethod = rng.choice(SHIPPING),
+        OrderInfo      = dict(
+            FirstName   = rng.choice(FIRST_NAMES),
+            LastName    = rng.choice(LAST_NAMES),
+            Address1    = u'%d %s' % (rng.randint(1, 9999), rng.choice(STREETS)),
+            City        = city,
+            State       = state,
+            PostalCode  = '%05d' % rng.randint(0, 99999),
+            CountryCode = country,
+            OrderDate   = datetime.datetime.now().strftime('%m/%d/%Y'),
+            PhoneNumber = '555-555-%04d' % rng.randint(0, 9999),
+        ),
+        Cases = [ dict(
+            CaseId     = n + 1,
+            CaseType   = rng.choice(spoke.CASE_TYPES),
+            Quantity   = rng.randint(1, 3),
+            PrintImage = dict(
+                ImageType = 'jpg',
+                Url       = 'http://example.com/art/%d.jpg' % rng.randint(1, 100000),
+            ),
+        ) for n in range(rng.randint(1, max_cases)) ],
+    )
+
+
+class Report(object):
+    '''
+        The outcome of a load run.  Latencies are in seconds.
+    '''
+
+    def __init__(self, latencies, errors, elapsed, cpu):
+        self.latencies = sorted(latencies)
+        self.errors    = errors
+        self.elapsed   = elapsed
+        self.cpu       = cpu
+
+    @property
+    def count(self):
+        return len(self.latencies)
+
+    @property
+    def throughput(self):
+        return self.count / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def cpu_per_order(self):
+        return self.cpu / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        '''
+            Returns the latency at percentile p (0-100), by nearest rank.
+        '''
+        if not self.latencies:
+            return 0.0
+        rank = max(0, int(round(p / 100.0 * len(self.latencies))) - 1)
+        return self.latencies[min(rank, len(self.latencies) - 1)]
+
+    def __str__(self):
+        lines = [
+            'orders:      %d in %.2fs' % (self.count, self.elapsed),
+            'throughput:  %.1f orders/s' % self.throughput,
+            'latency:     p50 %.1fms  p95 %.1fms  p99 %.1fms  max %.1fms' % tuple(
+                self.percentile(p) * 1000 for p in (50, 95, 99, 100)),
+            'cpu/order:   %.3fms' % (self.cpu_per_order * 1000),
+            'errors:      %d' % sum(self.errors.values()),
+        ]
+        for name, n in sorted(self.errors.items()):
+            lines.append('  %-20s %d' % (name, n))
+        return '\n'.join(lines)
+
+
+def run(client, count=1000, concurrency=8, rate=None, orders=None, seed=None):
+    '''
+        Submits count orders through client.new and returns a Report.
+
+        concurrency - The number of threads submitting orders
+        rate        - If given, the target number of orders started per second.
+                      Latencies are then measured from each order's scheduled
+                      start, so time spent waiting behind slow calls is counted
+        orders      - An iterable of Spoke.new keyword arguments to use instead
+                      of random_order
+        seed        - Seeds the random orders, for repeatable runs
+    '''
+    if orders is None:
+        rng    = random.Random(seed)
+        orders = ( random_order(rng, order_id=n) for n in range(count) )
+    orders = iter(orders)
+
+    lock      = threading.Lock()
+    latencies = []
+    errors    = collections.Counter()
+    issued    = [0]
+
+    def next_order():
+        with lock:
+            if issued[0] >= count:
+                return None, None
+            try:
+                order = next(orders)
+            except StopIteration:
+                return None, None
+            n = issued[0]
+            issued[0] += 1
+            return n, order
+
+    def worker():
+        while True:
+            n, order = next_order()
+            if order is None:
+                return
+            started = time.time()
+            if rate:
+                scheduled = begin + n / float(rate)
+                if scheduled > started:
+                    time.sleep(scheduled - started)
+                started = scheduled
+            try:
+                client.new(**order)
+            except Exception as e:
+                with lock:
+                    errors[type(e).__name__] += 1
+            latency = time.time() - started
+            with lock:
+                latencies.append(latency)
+
+    threads   = [ threading.Thread(target=worker) for _ in range(concurrency) ]
+    begin     = time.time()
+    cpu_begin = process_time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return Report(latencies, errors, time.time() - begin, process_time() - cpu_begin)
+
+
+def _serve(pipe):
+    server = FauxSpokeServer().start()
+    pipe.send(server.url)
+    pipe.recv()
+    server.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Drive synthetic orders through a Spoke client.')
+    parser.add_argument('--url', help='the endpoint to submit to (default: staging)')
+    parser.add_argument('--local', action='store_true', help='submit to a local stand-in for the API')
+    parser.add_argument('--customer', default='loadgen')
+    parser.add_argument('--key', default='loadgen')
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--rate', type=float, help='target orders per second')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args(argv)
+
+    server = None
+    if args.local:
+        parent, child = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=_serve, args=(child,))
+        server.start()
+        url = parent.recv()
+    else:
+        url = args.url or spoke.STAGING_URL
+    try:
+        client = spoke.Spoke(
+            production = False,
+            transport  = spoke.Transport(url, pool_size=args.concurrency),
+            Customer   = args.customer,
+            Key        = args.key,
+        )
+        print(run(client, count=args.count, concurrency=args.concurrency, rate=args.rate, seed=args.seed))
+    finally:
+        if server:
+            parent.send('stop')
+            server.join()
+
+
+if __name__ == '__main__':
+    main()
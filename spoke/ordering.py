@@ -0,0 +1,109 @@
+'''
+    Per-order ordering for concurrent submission.  An OrderedSubmitter runs
+    the calls for each OrderId one at a time, in the order they were made,
+    while calls for different orders run in parallel, so that a cancel never
+    overtakes the new or update before it.
+
+        submitter = OrderedSubmitter(client, workers=16)
+        submitter.new(OrderId=1, ...)
+        future = submitter.cancel(1)
+        future.result()
+
+    Updates that haven't started yet are dropped when a later update or a
+    cancel for the same order is queued: an update replaces the order's
+    whole OrderInfo, so only the last one matters, and none matter once the
+    order is cancelled.  The futures of dropped updates are cancelled.
+'''
+
+import collections
+import concurrent.futures
+import threading
+
+__all__ = ['OrderedSubmitter']
+
+
+class OrderedSubmitter(object):
+    '''
+        Makes client.new, update and cancel calls on workers threads,
+        serially per OrderId.  Each method returns a Future for the call's
+        result.
+    '''
+
+    def __init__(self, client, workers=8):
+        self.client     = client
+        self.dropped    = 0
+        self._executor  = concurrent.futures.ThreadPoolExecutor(workers)
+        self._condition = threading.Condition()
+        self._queues    = {} # OrderId -> calls not yet started, for orders with calls queued or running
+        self._closed    = False
+
+    def new(self, **kwargs):
+        return self._enqueue('new', kwargs)
+
+    def update(self, **kwargs):
+        return self._enqueue('update', kwargs)
+
+    def cancel(self, OrderId):
+        return self._enqueue('cancel', dict(OrderId=OrderId))
+
+    def __len__(self):
+        '''
+            The number of orders with calls queued or running.
+        '''
+        return len(self._queues)
+
+    def _enqueue(self, method, kwargs):
+        key     = str(kwargs.get('OrderId'))
+        future  = concurrent.futures.Future()
+        dropped = []
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('submitter is closed')
+            queue = self._queues.get(key)
+            idle  = queue is None
+            if idle:
+                queue = self._queues[key] = collections.deque()
+            elif method in ('update', 'cancel'):
+                dropped = [ call for call in queue if call[0] == 'update' ]
+                if dropped:
+                    queue = self._queues[key] = collections.deque( call for call in queue if call[0] != 'update' )
+                    self.dropped += len(dropped)
+            queue.append((method, kwargs, future))
+
+        for _, _, superseded in dropped:
+            superseded.cancel()
+        if idle:
+            self._executor.submit(self._run, key)
+        return future
+
+    def _run(self, key):
+        with self._condition:
+            method, kwargs, future = self._queues[key].popleft()
+
+        if future.set_running_or_notify_cancel():
+            try:
+                if method == 'cancel':
+                    future.set_result(self.client.cancel(kwargs['OrderId']))
+                else:
+                    future.set_result(getattr(self.client, method)(**kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+        with self._condition:
+            more = bool(self._queues[key])
+            if not more:
+                del self._queues[key]
+                self._condition.notify_all()
+        if more:
+            self._executor.submit(self._run, key)
+
+    def close(self):
+        '''
+            Stops accepting calls, waits for the queued ones to finish and
+            stops the workers.
+        '''
+        with self._condition:
+            self._closed = True
+            while self._queues:
+                self._condition.wait()
+        self._executor.shutdown()
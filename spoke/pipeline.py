@@ -0,0 +1,231 @@
+'''
+    A staged pipeline for bulk submission, so that CPU-bound validation and
+    serialization don't compete for the GIL with threads waiting on the
+    network.
+
+        pipeline = Pipeline(client, processes=4, senders=32)
+        results  = pipeline.run(orders)
+        print(pipeline.stats())
+
+    Orders are validated and serialized in a pool of processes (the prepare
+    stage), then sent and their responses parsed on a pool of threads (the
+    send stage).  The stages are joined by bounded queues, so a slow stage
+    holds back the ones before it instead of piling up work in memory.  The
+    stats of each stage (throughput, and how much work is queued for it)
+    show which stage limits the pipeline, to be sized separately.
+
+    The pipeline bypasses the client's preflight and recorder, and doesn't
+    skip unchanged updates; it uses the client's credentials, check_requests
+    option and transport.  The update_cache entry of each order it sends is
+    discarded, so that the client doesn't later skip an update because it
+    matches what the order held before.
+
+    The worker processes are given the parent's spoke.CATALOG, the
+    formatters registered with spoke.FORMATTERS and the XML_BACKEND in use
+    when run is called.  Unless processes are forked (the default only on
+    Linux before Python 3.14), they're pickled to get there, so registered
+    formatters must be picklable: module-level functions rather than
+    lambdas.
+'''
+
+import multiprocessing
+import threading
+import time
+
+from six.moves import queue
+
+import spoke
+
+__all__ = ['Pipeline', 'Stage']
+
+REQUEST_TYPES = dict(
+    new    = 'New',
+    update = 'Update',
+    cancel = 'Cancel',
+)
+
+_DONE = object()
+
+_worker_client = None
+
+
+def _worker_state():
+    # what workers need to validate and serialize as the parent does
+    return (
+        spoke.CATALOG.products(),
+        spoke.FORMATTERS.registered(),
+        spoke.XML_BACKEND.name,
+    )
+
+
+def _init_worker(Customer, Key, check_requests, state):
+    global _worker_client
+    products, formatters, backend = state
+    for code in set(spoke.CATALOG) - set( product.code for product in products ):
+        spoke.CATALOG.remove(code)
+    for product in products:
+        spoke.CATALOG.add(*product)
+    for cls, formatter in formatters:
+        spoke.FORMATTERS.register(cls, formatter)
+    if spoke.XML_BACKEND.name != backend:
+        spoke.XML_BACKEND = spoke.xml_backend(backend)
+
+    _worker_client = spoke.Spoke(
+        production     = False,
+        transport      = None,
+        check_requests = check_requests,
+        Customer       = Customer,
+        Key            = Key,
+    )
+
+
+def _prepare(method, kwargs):
+    client = _worker_client
+    if method == 'new':
+        order = client._prepare_new(kwargs)
+    elif method == 'update':
+        order = client._prepare_update(kwargs)
+    else:
+        order = dict(OrderId = kwargs['OrderId'])
+    return client._generate_request(REQUEST_TYPES[method], order)
+
+
+class Stage(object):
+    '''
+        The counters of one stage.  queue is the stage's input queue.
+    '''
+
+    def __init__(self, name, queue):
+        self.name      = name
+        self.queue     = queue
+        self.completed = 0
+        self.errors    = 0
+        self._lock     = threading.Lock()
+
+    def done(self, failed=False):
+        with self._lock:
+            self.completed += 1
+            self.errors    += failed
+
+    def stats(self, elapsed):
+        return dict(
+            completed   = self.completed,
+            errors      = self.errors,
+            queue_depth = self.queue.qsize(),
+            throughput  = self.completed / elapsed if elapsed else 0.0,
+        )
+
+
+class Pipeline(object):
+    '''
+        Submits orders through client with method (new, update or cancel).
+
+        processes  - The size of the prepare stage's process pool; defaults
+                     to the number of CPUs
+        senders    - The number of threads in the send stage
+        queue_size - The most items waiting for each stage
+        context    - The multiprocessing context to start processes with;
+                     by default, the default one
+    '''
+
+    def __init__(self, client, method='new', processes=None, senders=16, queue_size=64, context=None):
+        if method not in REQUEST_TYPES:
+            raise ValueError('unknown method %r' % (method,))
+        self.client     = client
+        self.method     = method
+        self.processes  = processes
+        self.senders    = senders
+        self.queue_size = queue_size
+        self.context    = context if context is not None else multiprocessing
+        self.started    = None
+        self.finished   = None
+        self.prepare    = Stage('prepare', queue.Queue(queue_size))
+        self.send       = Stage('send', queue.Queue(queue_size))
+
+    def stats(self):
+        '''
+            Returns the stats of each stage, by name.  Throughput is in items
+            per second since the run started.
+        '''
+        if self.started is None:
+            elapsed = 0
+        else:
+            elapsed = (self.finished or time.time()) - self.started
+        return dict( (stage.name, stage.stats(elapsed)) for stage in (self.prepare, self.send) )
+
+    def run(self, orders):
+        '''
+            Runs orders (keyword arguments for the method) through the
+            pipeline.  Returns a list with each order's result, or the
+            exception it raised, in the same order as orders.
+        '''
+        results = []
+        failure = []
+        pool    = self.context.Pool(
+            self.processes,
+            initializer = _init_worker,
+            initargs    = (self.client.Customer, self.client.Key, getattr(self.client, 'check_requests', False), _worker_state()),
+        )
+
+        def feed():
+            try:
+                for n, kwargs in enumerate(orders):
+                    results.append(None)
+                    self.prepare.queue.put((n, kwargs.get('OrderId'), pool.apply_async(_prepare, (self.method, kwargs))))
+            except Exception as e:
+                failure.append(e)
+            self.prepare.queue.put(_DONE)
+
+        def collect():
+            while True:
+                item = self.prepare.queue.get()
+                if item is _DONE:
+                    break
+                n, order_id, pending = item
+                try:
+                    request = pending.get()
+                except Exception as e:
+                    results[n] = e
+                    self.prepare.done(failed=True)
+                    continue
+                self.prepare.done()
+                self.send.queue.put((n, order_id, request))
+            for _ in range(self.senders):
+                self.send.queue.put(_DONE)
+
+        def send():
+            transport = self.client.transport
+            cache     = getattr(self.client, 'update_cache', None)
+            while True:
+                item = self.send.queue.get()
+                if item is _DONE:
+                    return
+                n, order_id, request = item
+                try:
+                    results[n] = self.client._parse_response(transport.send(request))
+                    self.send.done()
+                except Exception as e:
+                    results[n] = e
+                    self.send.done(failed=True)
+                finally:
+                    if cache is not None:
+                        cache.discard(order_id)
+
+        self.started  = time.time()
+        self.finished = None
+        threads = [ threading.Thread(target=feed), threading.Thread(target=collect) ]
+        threads.extend( threading.Thread(target=send) for _ in range(self.senders) )
+        try:
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            pool.close()
+            pool.join()
+            self.finished = time.time()
+
+        if failure:
+            raise failure[0]
+        return results
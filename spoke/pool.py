@@ -0,0 +1,212 @@
+'''
+    A pool of Spoke clients for submitting on behalf of many customers at
+    once.  All tenants share a single transport (and so a single connection
+    pool); each keeps its own Customer/Key and, optionally, its own rate
+    limit and share of the in-flight requests.
+'''
+
+import collections
+import threading
+import time
+
+import spoke
+
+__all__ = ['TenantPool', 'TokenBucket']
+
+
+class TokenBucket(object):
+    '''
+        Limits calls to rate per second, allowing bursts of up to burst calls.
+    '''
+
+    def __init__(self, rate, burst=1):
+        self.rate    = float(rate)
+        self.burst   = float(burst)
+        self._tokens = self.burst
+        self._last   = time.time()
+        self._lock   = threading.Lock()
+
+    def acquire(self):
+        '''
+            Takes a token, blocking until one is available.
+        '''
+        while True:
+            with self._lock:
+                now          = time.time()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last   = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class _Limits(object):
+    # a tenant's rate limit and share, kept across evictions of its client
+    def __init__(self, rate=None, share=None):
+        self.bucket = TokenBucket(rate) if rate else None
+        self.slots  = threading.BoundedSemaphore(share) if share else None
+
+
+class _Tenant(object):
+    def __init__(self, client, limits):
+        self.client = client
+        self.bucket = limits.bucket
+        self.slots  = limits.slots
+
+
+class TenantPool(object):
+    '''
+        Hands out one Spoke client per tenant, creating them on first use and
+        evicting the least recently used ones beyond max_clients.  A tenant's
+        rate limit and share outlive its client, so eviction never resets
+        them.
+
+            pool = TenantPool(production=True)
+            pool.register('shop-1', Customer='...', Key='...', rate=5)
+            pool.new('shop-1', OrderId=..., ...)
+
+        Instead of registering every tenant up front, a credentials function
+        may be given; it is called with the tenant whenever a client has to be
+        created and must return a dictionary with Customer and Key (and
+        optionally rate, share and any other Spoke options).
+    '''
+
+    def __init__(self, production=False, transport=None, max_clients=128, max_in_flight=None, credentials=None):
+        '''
+            production    - Whether or not to use the production API
+            transport     - The transport shared by every tenant; by default a
+                            Transport with a pool of max_in_flight (or 10) connections
+            max_clients   - The number of tenant clients kept around
+            max_in_flight - The number of requests allowed in flight across all tenants
+            credentials   - A function returning a tenant's credentials; see above
+        '''
+        if transport is None:
+            url       = spoke.PRODUCTION_URL if production else spoke.STAGING_URL
+            transport = spoke.Transport(url, pool_size=max_in_flight or 10)
+
+        self.production     = production
+        self.transport      = transport
+        self.max_clients    = max_clients
+        self.credentials    = credentials
+        self._registrations = {}
+        self._tenants       = collections.OrderedDict()
+        self._limits        = {}
+        self._creating      = {}
+        self._lock          = threading.Lock()
+        self._slots         = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+
+    def register(self, tenant, **credentials):
+        '''
+            Registers a tenant.  Takes Customer and Key, and optionally:
+
+            rate  - The maximum number of requests per second for this tenant
+            share - The maximum number of requests this tenant may have in flight
+
+            Any other keyword arguments are passed on to the tenant's Spoke client.
+        '''
+        with self._lock:
+            self._registrations[tenant] = credentials
+            self._tenants.pop(tenant, None)
+            self._limits.pop(tenant, None)
+
+    def _cached(self, tenant):
+        # called with the lock held
+        entry = self._tenants.pop(tenant, None)
+        if entry is not None:
+            self._tenants[tenant] = entry
+        return entry
+
+    def _tenant(self, tenant):
+        with self._lock:
+            entry = self._cached(tenant)
+            if entry is not None:
+                return entry
+            creating = self._creating.setdefault(tenant, threading.Lock())
+
+        # create the client outside the pool's lock, since the credentials
+        # function and prewarm may be slow, but only once per tenant
+        with creating:
+            try:
+                with self._lock:
+                    entry = self._cached(tenant)
+                if entry is None:
+                    entry = self._create(tenant)
+                return entry
+            finally:
+                with self._lock:
+                    self._creating.pop(tenant, None)
+
+    def _create(self, tenant):
+        with self._lock:
+            options = self._registrations.get(tenant)
+        if options is not None:
+            options = dict(options)
+        elif self.credentials is not None:
+            options = dict(self.credentials(tenant))
+        else:
+            raise KeyError('unknown tenant %r' % (tenant,))
+
+        rate   = options.pop('rate', None)
+        share  = options.pop('share', None)
+        client = spoke.Spoke(production=self.production, transport=self.transport, **options)
+
+        with self._lock:
+            limits = self._limits.get(tenant)
+            if limits is None:
+                limits = self._limits[tenant] = _Limits(rate, share)
+            entry = self._tenants[tenant] = _Tenant(client, limits)
+            while len(self._tenants) > self.max_clients:
+                self._tenants.popitem(last=False)
+        return entry
+
+    def client(self, tenant):
+        '''
+            Returns the Spoke client for a tenant.  Calls made directly on the
+            client bypass the tenant's rate limit and share.
+        '''
+        return self._tenant(tenant).client
+
+    def _call(self, tenant, method, *args, **kwargs):
+        entry = self._tenant(tenant)
+        if entry.bucket is not None:
+            entry.bucket.acquire()
+        if entry.slots is not None:
+            entry.slots.acquire()
+        try:
+            if self._slots is not None:
+                self._slots.acquire()
+            try:
+                return getattr(entry.client, method)(*args, **kwargs)
+            finally:
+                if self._slots is not None:
+                    self._slots.release()
+        finally:
+            if entry.slots is not None:
+                entry.slots.release()
+
+    def new(self, tenant, **kwargs):
+        '''
+            Creates a new order on behalf of tenant; see Spoke.new.
+        '''
+        return self._call(tenant, 'new', **kwargs)
+
+    def update(self, tenant, **kwargs):
+        '''
+            Updates an order on behalf of tenant; see Spoke.update.
+        '''
+        return self._call(tenant, 'update', **kwargs)
+
+    def cancel(self, tenant, OrderId):
+        '''
+            Cancels an order on behalf of tenant; see Spoke.cancel.
+        '''
+        return self._call(tenant, 'cancel', OrderId)
+
+    def warmup(self, n_connections=1, keepalive=None):
+        '''
+            Warms up the shared transport; see Spoke.warmup.
+        '''
+        if hasattr(self.transport, 'warmup'):
+            return self.transport.warmup(n_connections, keepalive)
@@ -0,0 +1,123 @@
+'''
+    Preflight checks of the image URLs in an order, so that orders with broken
+    artwork are caught before Spoke accepts them.
+
+        sp = spoke.Spoke(..., preflight=ImagePreflight())
+
+    URLs are checked concurrently with HEAD requests, and the results are
+    cached for ttl seconds, since most artwork is shared by many orders.
+    A URL that couldn't be checked at all (a timeout, a DNS failure, a reset
+    connection) fails the check, but is only cached for error_ttl seconds,
+    so that a network blip doesn't fail every order using it for an hour.
+'''
+
+import collections
+import concurrent.futures
+import threading
+import time
+
+import requests
+
+import spoke
+
+__all__ = ['ImagePreflight']
+
+
+def _image_urls(order):
+    images = [order.get('PackSlip')]
+    for case in order.get('Cases') or []:
+        if not isinstance(case, dict):
+            case = case.__dict__
+        images.append(case.get('PrintImage'))
+        images.append(case.get('QcImage'))
+
+    for image in images:
+        if image is None:
+            continue
+        if not isinstance(image, dict):
+            image = image.__dict__
+        yield image['Url']
+
+
+class ImagePreflight(object):
+    '''
+        Checks image URLs with HEAD requests on a pool of max_workers threads.
+
+        ttl       - How many seconds a result is cached for
+        error_ttl - How many seconds a failure to get any result is cached
+                    for; by default it isn't
+        max_size  - How many results are cached
+        timeout   - The timeout for each request, in seconds
+    '''
+
+    def __init__(self, max_workers=16, ttl=3600, max_size=100000, timeout=10, session=None, error_ttl=0):
+        self.ttl       = ttl
+        self.error_ttl = error_ttl
+        self.max_size  = max_size
+        self.timeout   = timeout
+        self.session   = session if session is not None else requests.Session()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self._lock     = threading.RLock()
+        self._results  = collections.OrderedDict()
+        self._pending  = {}
+
+    def _fetch(self, url):
+        '''
+            Returns whether url is reachable, and how long to cache that for.
+        '''
+        try:
+            res = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+            if res.status_code == 405: # some servers don't do HEAD
+                res = self.session.get(url, stream=True, timeout=self.timeout)
+                res.close()
+            return res.status_code < 400, self.ttl
+        except requests.RequestException:
+            return False, self.error_ttl
+
+    def _store(self, url, future):
+        ok, ttl = future.result()
+        with self._lock:
+            self._pending.pop(url, None)
+            self._results.pop(url, None)
+            if ttl <= 0:
+                return
+            self._results[url] = (ok, time.time() + ttl)
+            while len(self._results) > self.max_size:
+                self._results.popitem(last=False)
+
+    def check(self, urls):
+        '''
+            Returns a dictionary mapping each of urls to whether it's reachable.
+        '''
+        now     = time.time()
+        results = {}
+        futures = {}
+        with self._lock:
+            for url in set(urls):
+                cached = self._results.get(url)
+                if cached is not None and cached[1] > now:
+                    results[url] = cached[0]
+                    continue
+                future = self._pending.get(url)
+                if future is None:
+                    future = self._pending[url] = self._executor.submit(self._fetch, url)
+                    future.add_done_callback(lambda f, url=url: self._store(url, f))
+                futures[url] = future
+
+        for url, future in futures.items():
+            results[url] = future.result()[0]
+        return results
+
+    def check_order(self, order):
+        '''
+            Checks the PackSlip, PrintImage and QcImage URLs of an order (the
+            keyword arguments to Spoke.new), raising a ValidationError naming
+            the broken ones.
+        '''
+        results = self.check(_image_urls(order))
+        broken  = sorted( url for url, ok in results.items() if not ok )
+        if broken:
+            raise spoke.ValidationError('unreachable image URLs: %s' % ', '.join(broken))
+
+    def close(self):
+        self._executor.shutdown()
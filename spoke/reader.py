@@ -0,0 +1,172 @@
+'''
+    Reading of large JSON-lines order files.  An OrderFile memory-maps the
+    file, builds an index of line offsets once (kept in a sidecar file next
+    to it), and splits it into byte-range shards for parallel workers or
+    hosts.  Reading a shard with a checkpoint directory records progress as
+    it goes, so a restarted job resumes where it stopped.
+
+        orders = OrderFile('reimport.jsonl')
+        for shard in orders.shards(8):
+            ... hand shard to a worker, which does:
+
+        for order in orders.read(shard, checkpoints='/var/tmp/reimport'):
+            client.new(**order)
+'''
+
+import array
+import collections
+import json
+import mmap
+import os
+
+__all__ = ['OrderFile', 'Shard']
+
+Shard = collections.namedtuple('Shard', 'number count start end')
+
+INDEX_MAGIC = b'SPKIDX1\n'
+
+
+class OrderFile(object):
+    '''
+        A memory-mapped file with one JSON order per line.
+    '''
+
+    def __init__(self, path):
+        self.path   = path
+        self._file  = open(path, 'rb')
+        self.size   = os.fstat(self._file.fileno()).st_size
+        self._map   = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+        self._index = None
+
+    def close(self):
+        if self.size:
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def index_path(self):
+        return self.path + '.idx'
+
+    def index(self):
+        '''
+            Returns an array of the offsets at which lines start, building it
+            on first use.  The index is saved next to the file and reused as
+            long as the file's size and modification time don't change.
+        '''
+        if self._index is None:
+            self._index = self._load_index()
+            if self._index is None:
+                self._index = self._build_index()
+                self._save_index()
+        return self._index
+
+    def _stamp(self):
+        stat = os.stat(self.path)
+        return ('%d %d\n' % (stat.st_size, int(stat.st_mtime * 1000))).encode('ascii')
+
+    def _build_index(self):
+        offsets = array.array('Q')
+        find    = self._map.find
+        start   = 0
+        while start < self.size:
+            offsets.append(start)
+            end = find(b'\n', start)
+            if end < 0:
+                break
+            start = end + 1
+        return offsets
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                if f.readline() != INDEX_MAGIC or f.readline() != self._stamp():
+                    return None
+                offsets = array.array('Q')
+                offsets.frombytes(f.read())
+                return offsets
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _save_index(self):
+        try:
+            tmp = self.index_path + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(INDEX_MAGIC + self._stamp())
+                f.write(self._index.tobytes())
+            os.replace(tmp, self.index_path)
+        except (IOError, OSError):
+            pass # a read-only directory only costs a rebuild next time
+
+    def __len__(self):
+        return len(self.index())
+
+    def shards(self, count):
+        '''
+            Splits the file into count shards of (nearly) equal numbers of
+            lines, each a byte range starting and ending on a line boundary.
+        '''
+        index  = self.index()
+        shards = []
+        for number in range(count):
+            first = len(index) * number // count
+            last  = len(index) * (number + 1) // count
+            start = index[first] if first < len(index) else self.size
+            end   = index[last] if last < len(index) else self.size
+            shards.append(Shard(number, count, start, end))
+        return shards
+
+    def _checkpoint_path(self, checkpoints, shard):
+        name = '%s.%d-of-%d.checkpoint' % (os.path.basename(self.path), shard.number, shard.count)
+        return os.path.join(checkpoints, name)
+
+    def checkpoint(self, checkpoints, shard):
+        '''
+            Returns the offset up to which shard has been read, according to
+            the checkpoint directory checkpoints.
+        '''
+        try:
+            with open(self._checkpoint_path(checkpoints, shard)) as f:
+                return max(shard.start, int(f.read()))
+        except (IOError, OSError, ValueError):
+            return shard.start
+
+    def _save_checkpoint(self, checkpoints, shard, offset):
+        path = self._checkpoint_path(checkpoints, shard)
+        with open(path + '.tmp', 'w') as f:
+            f.write(str(offset))
+        os.replace(path + '.tmp', path)
+
+    def read(self, shard=None, checkpoints=None, every=1000):
+        '''
+            Yields the orders in shard (or the whole file), decoded from JSON.
+
+            If checkpoints is given, it's a directory in which progress through
+            the shard is recorded every every orders.  An order counts as done
+            once the next one has been asked for, so an order whose processing
+            is interrupted is read again on resume.
+        '''
+        if shard is None:
+            shard = Shard(0, 1, 0, self.size)
+        offset = self.checkpoint(checkpoints, shard) if checkpoints else shard.start
+
+        find  = self._map.find
+        count = 0
+        while offset < shard.end:
+            end  = find(b'\n', offset, shard.end)
+            stop = end if end >= 0 else shard.end
+            line = self._map[offset:stop]
+            if line.strip():
+                yield json.loads(line.decode('utf-8'))
+                count += 1
+            offset = stop + 1
+            if checkpoints and count % every == 0:
+                self._save_checkpoint(checkpoints, shard, offset)
+
+        if checkpoints:
+            self._save_checkpoint(checkpoints, shard, shard.end)
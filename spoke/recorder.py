@@ -0,0 +1,156 @@
+'''
+    A flight recorder for a Spoke client: a fixed-size ring buffer holding
+    the last few calls (request type, OrderId, sizes, phase timings, the
+    start of each body and the outcome), cheap enough to leave on in
+    production.
+
+        recorder = FlightRecorder(size=1000, error_rate=0.2, dump_dir='/var/log/spoke')
+        sp = spoke.Spoke(..., recorder=recorder)
+
+    The buffer is written out as JSON lines when the error rate over the last
+    window calls goes over error_rate, or on demand with dump.  Dumps are
+    readable only by their owner, and the Customer and Key of each request
+    are redacted before it's kept.
+'''
+
+import json
+import os
+import re
+import threading
+import time
+
+__all__ = ['CallRecord', 'FlightRecorder']
+
+OK = 'ok'
+
+CREDENTIALS = re.compile(br'<(Customer|Key)>[^<]*</\1>')
+REDACTED    = br'<\1>redacted</\1>'
+
+
+def _redact(request):
+    # both come first in a request, so stop as soon as they're found
+    return CREDENTIALS.sub(REDACTED, request, 2)
+
+
+def _text(body):
+    if body is None or isinstance(body, str):
+        return body
+    return body.decode('utf-8', 'replace')
+
+
+class CallRecord(object):
+    '''
+        One call.  Phase timings are in seconds, and None for phases the call
+        didn't reach; outcome is 'ok' or the name of the exception raised.
+    '''
+    __slots__ = (
+        'started', 'request_type', 'order_id', 'request_size', 'response_size',
+        'serialize', 'send', 'parse', 'request', 'response', 'outcome', 'error',
+    )
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+    def as_dict(self):
+        d = dict( (name, getattr(self, name)) for name in self.__slots__ )
+        d['request']  = _text(self.request)
+        d['response'] = _text(self.response)
+        return d
+
+
+class FlightRecorder(object):
+    '''
+        Keeps the last size calls in a preallocated ring buffer.
+
+        body_limit - How many bytes of each request and response are kept
+        error_rate - If given, the buffer is dumped when more than this
+                     fraction of the last window calls failed
+        window     - The number of calls the error rate is measured over
+        cooldown   - The fewest seconds between automatic dumps
+        dump_dir   - Where automatic dumps are written; required with
+                     error_rate
+    '''
+
+    def __init__(self, size=1000, body_limit=512, error_rate=None, window=100, cooldown=60, dump_dir=None):
+        if error_rate is not None and dump_dir is None:
+            raise ValueError('error_rate needs a dump_dir')
+        self.size       = size
+        self.body_limit = body_limit
+        self.error_rate = error_rate
+        self.window     = window
+        self.cooldown   = cooldown
+        self.dump_dir   = dump_dir
+        self.last_dump  = None
+        self.calls      = 0
+        self._records   = [ CallRecord() for _ in range(size) ]
+        self._failures  = bytearray(window)
+        self._failed    = 0
+        self._dumped_at = None
+        self._lock      = threading.Lock()
+
+    def record(self, request_type, order_id, marks, request=None, response=None, error=None):
+        '''
+            Records a call.  marks holds the time it started followed by the
+            time each phase (serialize, send, parse) finished, as far as it
+            got.
+        '''
+        phases = [ marks[n + 1] - marks[n] if n + 1 < len(marks) else None for n in range(3) ]
+        failed = error is not None
+        limit  = self.body_limit
+        if request is not None:
+            size    = len(request)
+            request = _redact(request)[:limit]
+
+        with self._lock:
+            slot = self._records[self.calls % self.size]
+            slot.started       = marks[0]
+            slot.request_type  = request_type
+            slot.order_id      = order_id
+            slot.request_size  = size if request is not None else None
+            slot.response_size = len(response) if response is not None else None
+            slot.serialize, slot.send, slot.parse = phases
+            slot.request       = request
+            slot.response      = response[:limit] if response is not None else None
+            slot.outcome       = type(error).__name__ if failed else OK
+            slot.error         = str(error) if failed else None
+
+            n = self.calls % self.window
+            self._failed += failed - self._failures[n]
+            self._failures[n] = failed
+            self.calls += 1
+            tripped = (
+                failed and self.error_rate is not None and self.calls >= self.window and
+                self._failed > self.error_rate * self.window and
+                (self._dumped_at is None or marks[-1] - self._dumped_at >= self.cooldown)
+            )
+            if tripped:
+                self._dumped_at = marks[-1]
+
+        if tripped:
+            name = 'spoke-flight-%s-%d.jsonl' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+            self.last_dump = os.path.join(self.dump_dir, name)
+            self.dump(self.last_dump)
+
+    def records(self):
+        '''
+            Returns the recorded calls, oldest first, as dictionaries.
+        '''
+        with self._lock:
+            count = min(self.calls, self.size)
+            first = self.calls - count
+            return [ self._records[n % self.size].as_dict() for n in range(first, self.calls) ]
+
+    def dump(self, f):
+        '''
+            Writes the recorded calls to f (a file object or path) as JSON
+            lines, oldest first.  A path is written with mode 0600.
+        '''
+        if not hasattr(f, 'write'):
+            fd = os.open(f, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            if hasattr(os, 'fchmod'):
+                os.fchmod(fd, 0o600) # in case it already existed
+            with os.fdopen(fd, 'w') as out:
+                return self.dump(out)
+        for record in self.records():
+            f.write(json.dumps(record) + '\n')
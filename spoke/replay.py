@@ -0,0 +1,141 @@
+'''
+    Recording and replaying of API traffic.  RecordingTransport wraps another
+    transport and appends every exchange to a capture file; ReplayTransport
+    feeds the captured responses back, so benchmarks and tests can run
+    against real production payloads offline.
+
+        sp = spoke.Spoke(..., transport=RecordingTransport(spoke.Transport(url), 'traffic.cap'))
+
+        sp = spoke.Spoke(..., transport=ReplayTransport('traffic.cap', timing='fast'))
+
+    A capture file is a magic header followed by records, each a fixed-size
+    header (flags, start time, elapsed time and the two body lengths) and then
+    the raw request and response bodies.
+'''
+
+import collections
+import struct
+import threading
+import time
+
+__all__ = ['Exchange', 'RecordingTransport', 'ReplayTransport', 'read_capture']
+
+MAGIC  = b'SPOKECAP1\n'
+RECORD = struct.Struct('>BddII')
+
+# record flags
+FAILED = 1
+
+Exchange = collections.namedtuple('Exchange', 'started elapsed request response failed')
+
+
+def _to_bytes(body):
+    if isinstance(body, bytes):
+        return body
+    return body.encode('utf-8')
+
+
+class RecordingTransport(object):
+    '''
+        Sends through inner and appends each exchange to the capture file at
+        path.  Failed sends are recorded with their error message as the
+        response, and re-raised.
+    '''
+
+    def __init__(self, inner, path):
+        self.inner = inner
+        self._lock = threading.Lock()
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+            self._file.flush()
+
+    def send(self, request):
+        started = time.time()
+        try:
+            response = self.inner.send(request)
+        except Exception as e:
+            self._record(FAILED, started, request, str(e))
+            raise
+        self._record(0, started, request, response)
+        return response
+
+    def _record(self, flags, started, request, response):
+        elapsed  = time.time() - started
+        request  = _to_bytes(request)
+        response = _to_bytes(response)
+        header   = RECORD.pack(flags, started, elapsed, len(request), len(response))
+        with self._lock:
+            self._file.write(header + request + response)
+            self._file.flush()
+
+    def warmup(self, n_connections=1, keepalive=None):
+        if hasattr(self.inner, 'warmup'):
+            return self.inner.warmup(n_connections, keepalive)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_capture(path):
+    '''
+        Yields the Exchanges recorded in a capture file, in order.
+    '''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a spoke capture file' % path)
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            flags, started, elapsed, request_len, response_len = RECORD.unpack(header)
+            request  = f.read(request_len)
+            response = f.read(response_len)
+            if len(response) < response_len:
+                return # a partially written last record
+            yield Exchange(started, elapsed, request, response, bool(flags & FAILED))
+
+
+class ReplayTransport(object):
+    '''
+        Answers sends with the responses from a capture file, in the order they
+        were recorded, regardless of the request.  Failed exchanges are replayed
+        by raising IOError.
+
+        timing - 'original' to take as long as the recorded call did, or
+                 'fast' to answer immediately
+        loop   - Whether to start over at the end of the capture, rather than
+                 raising EOFError
+    '''
+
+    def __init__(self, path, timing='original', loop=False):
+        if timing not in ('original', 'fast'):
+            raise ValueError('timing must be "original" or "fast"')
+        self.path      = path
+        self.timing    = timing
+        self.loop      = loop
+        self.requests  = 0
+        self._lock     = threading.Lock()
+        self._captured = read_capture(path)
+
+    def _next(self):
+        with self._lock:
+            for exchange in self._captured:
+                self.requests += 1
+                return exchange
+            if not self.loop:
+                raise EOFError('capture %s exhausted' % self.path)
+            self._captured = read_capture(self.path)
+            for exchange in self._captured:
+                self.requests += 1
+                return exchange
+            raise EOFError('capture %s is empty' % self.path)
+
+    def send(self, request):
+        exchange = self._next()
+        if self.timing == 'original':
+            time.sleep(exchange.elapsed)
+        if exchange.failed:
+            raise IOError(exchange.response.decode('utf-8'))
+        return exchange.response
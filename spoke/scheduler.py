@@ -0,0 +1,119 @@
+'''
+    Priority scheduling of order submissions, so that urgent shipping methods
+    don't wait behind a backlog of slower ones.
+
+        scheduler = PriorityScheduler(client, workers=16)
+        future    = scheduler.submit(OrderId=..., ShippingMethod='Overnight', ...)
+        result    = future.result()
+
+    Each order gets a score measured in seconds: the time it was queued, less
+    a head start for its shipping method, capped by its deadline (if any) less
+    a lead time.  Orders are sent lowest score first.  Since the head starts
+    are fixed, a low priority order waits at most its head start difference
+    behind higher priority ones, and never starves.  Scores never change once
+    queued, so the queue is a plain binary heap.
+'''
+
+import concurrent.futures
+import heapq
+import itertools
+import threading
+import time
+
+__all__ = ['HEAD_STARTS', 'PriorityScheduler']
+
+# seconds of head start, per shipping method
+HEAD_STARTS = dict(
+    Overnight       = 4 * 3600,
+    SecondDay       = 2 * 3600,
+    PriorityMail    = 1800,
+    TrackedDelivery = 1800,
+    FirstClass      = 0,
+)
+
+
+class PriorityScheduler(object):
+    '''
+        Sends orders through client.new from a priority queue, with workers
+        threads.
+
+        key         - A function from an order's keyword arguments to its head
+                      start in seconds; by default, looks up its ShippingMethod
+                      in head_starts
+        head_starts - Head starts by shipping method; defaults to HEAD_STARTS
+        lead_time   - How many seconds before its deadline an order should be
+                      sent
+    '''
+
+    def __init__(self, client, workers=8, key=None, head_starts=None, lead_time=600, clock=time.time):
+        self.client      = client
+        self.head_starts = HEAD_STARTS if head_starts is None else head_starts
+        self.key         = key if key is not None else self._head_start
+        self.lead_time   = lead_time
+        self.clock       = clock
+        self._heap       = []
+        self._sequence   = itertools.count()
+        self._condition  = threading.Condition()
+        self._closed     = False
+        self._threads    = [ threading.Thread(target=self._worker) for _ in range(workers) ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _head_start(self, order):
+        return self.head_starts.get(order.get('ShippingMethod'), 0)
+
+    def score(self, order, deadline=None):
+        '''
+            Returns the score an order queued now would get.
+        '''
+        score = self.clock() - self.key(order)
+        if deadline is not None:
+            score = min(score, deadline - self.lead_time)
+        return score
+
+    def submit(self, deadline=None, **kwargs):
+        '''
+            Queues an order (keyword arguments for client.new), to be sent
+            ahead of its deadline if one is given.  Returns a Future for its
+            result.
+        '''
+        future = concurrent.futures.Future()
+        entry  = (self.score(kwargs, deadline), next(self._sequence), kwargs, future)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('scheduler is closed')
+            heapq.heappush(self._heap, entry)
+            self._condition.notify()
+        return future
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                while not self._heap and not self._closed:
+                    self._condition.wait()
+                if not self._heap:
+                    return
+                _, _, kwargs, future = heapq.heappop(self._heap)
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self.client.new(**kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+    def close(self, wait=True):
+        '''
+            Stops accepting orders.  The workers finish the queued ones and
+            exit; if wait is true, waits for them.
+        '''
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
@@ -0,0 +1,168 @@
+'''
+    A local stand-in for the Spoke API.  Useful for tests and benchmarks that
+    need a real HTTP endpoint without talking to Spoke itself.
+'''
+
+import itertools
+import threading
+import time
+import zlib
+
+from six.moves import BaseHTTPServer, socketserver
+
+SUCCESS_RESPONSE = '''<ResponseSuccess>
+  <result>Success</result>
+  <time>11/10/2011 03:50:28 -05:00</time>
+  <immc_id>%d</immc_id>
+</ResponseSuccess>'''
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version        = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.stand_in._connection_opened()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=b'', headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self._reply(self.server.stand_in._head(self.path))
+
+    def do_POST(self):
+        stand_in = self.server.stand_in
+        length   = int(self.headers.get('Content-Length', 0))
+        body     = self.rfile.read(length)
+        if stand_in._hang_up():
+            self.close_connection = True
+            return
+        stand_in._received(len(body))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+        status, response = stand_in._handle(self.path, self.headers, body)
+        headers = [('Content-Type', 'text/xml; charset=utf-8')]
+        if stand_in.compress_responses and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            response   = compressor.compress(response) + compressor.flush()
+            headers.append(('Content-Encoding', 'gzip'))
+        self._reply(status, response, headers)
+        if not stand_in.keepalive:
+            self.close_connection = True # without saying so
+
+
+class _Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads      = True
+    allow_reuse_address = True
+
+
+class FauxSpokeServer(object):
+    '''
+        Serves Spoke-shaped success responses on a local port, in a background
+        thread.  Counts the connections and requests it sees.  Set status to
+        make it answer with an HTTP error instead.
+
+        HEAD requests succeed, except for paths added to missing, so the
+        server can also stand in for an image host.
+
+        Gzip-compressed request bodies are decompressed (requests records
+        the decompressed body, bytes_received what was on the wire).  Set
+        compress_responses to gzip responses for clients that accept it,
+        bandwidth (bytes per second) to simulate a slow link for uploads, and
+        delay (seconds) to hold back each response after the request is
+        recorded.
+
+        To test clients' handling of dropped connections, clear keepalive to
+        close each connection after its response without warning, or set
+        hang_up to close the connections of that many requests instead of
+        answering them (they aren't recorded).
+
+            server = FauxSpokeServer().start()
+            sp = spoke.Spoke(..., transport=spoke.Transport(server.url))
+            ...
+            server.stop()
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host               = host
+        self.port               = port
+        self.status             = 200
+        self.missing            = set()
+        self.connections        = 0
+        self.requests           = []
+        self.heads              = []
+        self.compress_responses = False
+        self.bandwidth          = None
+        self.delay              = None
+        self.keepalive          = True
+        self.hang_up            = 0
+        self.bytes_received     = 0
+        self._lock              = threading.Lock()
+        self._immc_ids          = itertools.count(1)
+        self._server            = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d/order/submit' % (self.host, self.port)
+
+    def start(self):
+        self._server = _Server((self.host, self.port), _Handler)
+        self._server.stand_in = self
+        self.port = self._server.server_address[1]
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _connection_opened(self):
+        with self._lock:
+            self.connections += 1
+
+    def _received(self, n_bytes):
+        with self._lock:
+            self.bytes_received += n_bytes
+        if self.bandwidth:
+            time.sleep(float(n_bytes) / self.bandwidth)
+
+    def _hang_up(self):
+        with self._lock:
+            if self.hang_up:
+                self.hang_up -= 1
+                return True
+        return False
+
+    def _head(self, path):
+        with self._lock:
+            self.heads.append(path)
+        return 404 if path in self.missing else 200
+
+    def _handle(self, path, headers, body):
+        with self._lock:
+            self.requests.append(body)
+            immc_id = next(self._immc_ids)
+        if self.delay:
+            time.sleep(self.delay)
+        return self.status, (SUCCESS_RESPONSE % immc_id).encode('utf-8')
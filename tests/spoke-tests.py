@@ -1,10 +1,26 @@
 # vim: fileencoding=utf8
 
 import spoke
+from spoke import agent, breaker, concurrency, decode, loadgen, ordering, pipeline, preflight, reader, recorder, replay
+from spoke.pool import TenantPool
+from spoke import scheduler as scheduler_module
+from spoke.testing import FauxSpokeServer
 import unittest
-from datetime import datetime
+from datetime import date, datetime
+import decimal
+import enum
+import io
+import json
+import multiprocessing
 import os
+import pickle
 import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
 
 CUSTOMER_NAME   = 'abc123'
 CUSTOMER_KEY    = 'abc123'
@@ -31,6 +47,49 @@ class FauxTransport(object):
 </ResponseSuccess>'''
 
 
+class RecordingFauxTransport(object):
+    def __init__(self):
+        self.requests = []
+
+    def send(self, request):
+        self.requests.append(request)
+        return b'''<?xml version="1.0" encoding="utf-8" ?>
+<ResponseSuccess>
+  <result>Success</result>
+  <time>11/10/2011 03:50:28 -05:00</time>
+  <immc_id>12345</immc_id>
+</ResponseSuccess>'''
+
+
+def new_order_params(**overrides):
+    params = dict(
+        Cases = [dict(
+            CaseId     = 1234,
+            CaseType   = 'iph4tough',
+            PrintImage = dict(
+                ImageType = 'jpg',
+                Url       = 'http://threadless.com/nothing.jpg',
+            ),
+            Quantity = 1,
+        )],
+        OrderId   = 2,
+        OrderInfo = dict(
+            Address1    = FAUX_ADDRESS,
+            City        = FAUX_CITY,
+            CountryCode = 'US',
+            FirstName   = FAUX_FIRST_NAME,
+            LastName    = FAUX_LAST_NAME,
+            OrderDate   = datetime.now(),
+            PhoneNumber = FAUXN_NUMBER,
+            PostalCode  = FAUX_ZIP,
+            State       = FAUX_STATE,
+        ),
+        ShippingMethod = 'FirstClass',
+    )
+    params.update(overrides)
+    return params
+
+
 class SpokeTests(unittest.TestCase):
     def test_constructor_required_fields(self):
         params = dict(
@@ -594,4 +653,1563 @@ class SpokeTests(unittest.TestCase):
 
         result = sp.cancel(order_id)
 
-        self.assertTrue('immc_id' in result)
\ No newline at end of file
+        self.assertTrue('immc_id' in result)
+
+class TransportTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FauxSpokeServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_warmup_opens_pooled_connections(self):
+        sp = spoke.Spoke(
+            Customer   = CUSTOMER_NAME,
+            Key        = CUSTOMER_KEY,
+            production = False,
+            transport  = spoke.Transport(self.server.url),
+        )
+
+        self.assertEqual(sp.warmup(3), 3)
+        self.assertEqual(self.server.connections, 3)
+
+        sp.cancel(2)
+        self.assertEqual(self.server.connections, 3)
+        self.assertEqual(len(self.server.requests), 1)
+
+
+    def test_prewarm_constructor_flag(self):
+        transport = spoke.Transport(self.server.url, pool_size=2)
+        spoke.Spoke(
+            Customer   = CUSTOMER_NAME,
+            Key        = CUSTOMER_KEY,
+            production = False,
+            transport  = transport,
+            prewarm    = 4,
+        )
+
+        self.assertEqual(self.server.connections, 4)
+        self.assertEqual(transport.pool_size, 4)
+
+
+    def test_warmup_closes_outgrown_pool(self):
+        transport = spoke.Transport(self.server.url, pool_size=1)
+        transport.warmup(1)
+        old = transport.adapter
+
+        transport.warmup(3)
+        self.assertIsNot(transport.adapter, old)
+        self.assertEqual(len(old.poolmanager.pools), 0)
+
+
+    def test_warmup_keepalive(self):
+        transport = spoke.Transport(self.server.url)
+        transport.warmup(1, keepalive=0.05)
+        try:
+            time.sleep(0.3)
+        finally:
+            transport.close()
+
+        self.assertEqual(self.server.connections, 1)
+        self.assertTrue(len(self.server.heads) > 1)
+
+
+    def test_warmup_unsupported_transport(self):
+        sp = spoke.Spoke(
+            Customer   = CUSTOMER_NAME,
+            Key        = CUSTOMER_KEY,
+            production = False,
+            transport  = FauxTransport(),
+            prewarm    = 2,
+        )
+        self.assertEqual(sp.warmup(2), None)
+
+
+    def test_compression(self):
+        transport = spoke.Transport(self.server.url, compress_threshold=1024, compress_level=1)
+        sp = spoke.Spoke(
+            Customer   = CUSTOMER_NAME,
+            Key        = CUSTOMER_KEY,
+            production = False,
+            transport  = transport,
+        )
+        self.server.compress_responses = True
+
+        sp.cancel(2) # below the threshold
+        self.assertEqual(self.server.bytes_received, len(self.server.requests[0]))
+
+        bulk = loadgen.random_order(random.Random(3), order_id=3)
+        bulk['Cases'] = [ dict(case, CaseId=n) for n, case in enumerate(new_order_params()['Cases'] * 100) ]
+        self.assertEqual(sp.new(**bulk), dict(immc_id=2))
+        received = self.server.bytes_received - len(self.server.requests[0])
+        self.assertTrue(b'<RequestType>New</RequestType>' in self.server.requests[1])
+        self.assertTrue(received * 10 < len(self.server.requests[1]))
+
+
+class SchemaTests(unittest.TestCase):
+    def setUp(self):
+        self.transport = RecordingFauxTransport()
+        self.sp = spoke.Spoke(
+            Customer       = CUSTOMER_NAME,
+            Key            = CUSTOMER_KEY,
+            production     = False,
+            transport      = self.transport,
+            check_requests = True,
+        )
+
+    def test_valid_requests_are_sent(self):
+        self.assertEqual(self.sp.new(**new_order_params()), dict(immc_id = 12345))
+        self.sp.update(OrderId = 2, OrderInfo = new_order_params()['OrderInfo'])
+        self.sp.cancel(2)
+        self.assertEqual(len(self.transport.requests), 3)
+
+
+    def test_invalid_request_fails_before_sending(self):
+        params = new_order_params()
+        params['Cases'][0]['Quantity'] = 'lots'
+
+        self.assertRaises(spoke.ValidationError, self.sp.new, **params)
+        self.assertEqual(self.transport.requests, [])
+
+
+    def test_unchecked_by_default(self):
+        sp = spoke.Spoke(
+            Customer   = CUSTOMER_NAME,
+            Key        = CUSTOMER_KEY,
+            production = False,
+            transport  = self.transport,
+        )
+        params = new_order_params()
+        params['Cases'][0]['Quantity'] = 'lots'
+
+        sp.new(**params)
+        self.assertEqual(len(self.transport.requests), 1)
+
+
+class TrustedTests(unittest.TestCase):
+    def setUp(self):
+        self.transport = RecordingFauxTransport()
+        self.sp = spoke.Spoke(
+            Customer   = CUSTOMER_NAME,
+            Key        = CUSTOMER_KEY,
+            production = False,
+            transport  = self.transport,
+        )
+
+    def tearDown(self):
+        spoke.TRUSTED_SAMPLE_RATE = 0.0
+
+    def test_from_trusted_serializes_like_validated(self):
+        case = new_order_params()['Cases'][0]
+        info = dict(new_order_params()['OrderInfo'], OrderDate = '11/08/2011')
+
+        self.sp.new(**new_order_params(Cases = [spoke.Case(**dict(case))], OrderInfo = dict(info)))
+        self.sp.new(**new_order_params(Cases = [spoke.Case.from_trusted(case)], OrderInfo = dict(info)))
+
+        validated, trusted = self.transport.requests
+        self.assertEqual(validated, trusted)
+
+
+    def test_new_without_validation(self):
+        params = new_order_params()
+        params['OrderInfo']['OrderDate'] = '11/08/2011'
+
+        self.sp.new(**dict(params, Cases = list(params['Cases']), OrderInfo = dict(params['OrderInfo'])))
+        self.sp.new(validate = False, **params)
+
+        validated, trusted = self.transport.requests
+        self.assertEqual(validated, trusted)
+        self.assertTrue(b'<ShippingMethod>FC</ShippingMethod>' in trusted)
+
+
+    def test_trusted_data_is_not_checked(self):
+        spoke.Case.from_trusted(dict(CaseType = 'nonsense'))
+        self.sp.update(validate = False, OrderId = 1, OrderInfo = dict(FirstName = FAUX_FIRST_NAME))
+
+
+    def test_sampled_trusted_data_is_checked(self):
+        spoke.TRUSTED_SAMPLE_RATE = 1.0
+
+        self.assertRaises(spoke.ValidationError, spoke.Case.from_trusted, dict(CaseType = 'nonsense'))
+        self.assertRaises(spoke.ValidationError, self.sp.update,
+            validate  = False,
+            OrderId   = 1,
+            OrderInfo = dict(FirstName = FAUX_FIRST_NAME),
+        )
+        self.assertTrue(isinstance(spoke.Image.from_trusted(dict(ImageType = 'jpg', Url = 'x')), spoke.Image))
+
+
+class FieldAssignmentTests(unittest.TestCase):
+    def order_info(self):
+        params = new_order_params()['OrderInfo']
+        params['OrderDate'] = '11/08/2011'
+        return spoke.OrderInfo(**params)
+
+    def test_assignment_is_validated(self):
+        info = self.order_info()
+        info.PostalCode = '60601'
+        self.assertEqual(info.__dict__['PostalCode'], '60601')
+
+        info.Prices = dict(TaxCents = 10)
+        self.assertTrue(isinstance(info.Prices, spoke.Prices))
+        self.assertRaises(spoke.ValidationError, setattr, info, 'Prices', dict(DisplayOnPackingSlip = 'Maybe'))
+        self.assertRaises(spoke.ValidationError, setattr, info, 'PostalCod', '60601')
+
+    def test_deletion(self):
+        info = self.order_info()
+        info.GiftMessage = 'Enjoy'
+        del info.GiftMessage
+        self.assertFalse('GiftMessage' in info.__dict__)
+        self.assertRaises(spoke.ValidationError, delattr, info, 'PostalCode')
+
+    def test_valid_objects_are_not_revalidated(self):
+        info = self.order_info()
+        info.__dict__['Prices'] = 'not validated' # bypasses the field
+        self.assertTrue(info.validate() is info)
+
+    def test_pickling_keeps_validity(self):
+        info = pickle.loads(pickle.dumps(self.order_info(), pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(info.PostalCode, self.order_info().PostalCode)
+        self.assertTrue(info._valid)
+
+        case = pickle.loads(pickle.dumps(spoke.Case.from_trusted(dict(CaseType = 'nonsense')), pickle.HIGHEST_PROTOCOL))
+        self.assertFalse(case._valid)
+        self.assertRaises(spoke.ValidationError, case.validate)
+
+    def test_trusted_objects_are_validated_once(self):
+        case = spoke.Case.from_trusted(dict(CaseType = 'nonsense'))
+        self.assertRaises(spoke.ValidationError, case.validate)
+
+        info = spoke.OrderInfo.from_trusted(dict(self.order_info().__dict__, Prices = dict(TaxCents = 10)))
+        info.validate()
+        self.assertTrue(isinstance(info.Prices, spoke.Prices))
+
+        self.assertTrue(pickle.loads(pickle.dumps(info)).validate())
+
+
+class ProductCatalogTests(unittest.TestCase):
+    def test_bundled_catalog(self):
+        self.assertTrue(len(spoke.CATALOG) > 100)
+        self.assertEqual(spoke.CATALOG['SP10603'].family, 'tough')
+        self.assertEqual(spoke.CATALOG['iph4bt'].family, 'slim')
+        self.assertEqual(spoke.CATALOG['mug11oz'].category, 'mug')
+        self.assertEqual(spoke.CASE_TYPES, tuple(spoke.CATALOG))
+
+    def test_codes_are_interned(self):
+        case = dict(new_order_params()['Cases'][0], CaseType = ''.join(['iph4', 'tough']))
+        self.assertTrue(spoke.Case(**case).CaseType is spoke.Case(**dict(case)).CaseType)
+
+    def test_extend_and_override(self):
+        catalog = spoke.ProductCatalog.from_file(spoke.PRODUCTS_PATH)
+        validator = spoke.InCatalog(catalog)
+        self.assertRaises(spoke.ValidationError, validator, 'SP99999')
+
+        catalog.add('SP99999', category = 'case', family = 'slim')
+        catalog.add('iph4tough', category = 'case', family = 'rugged')
+        self.assertEqual(validator('SP99999'), 'SP99999')
+        self.assertEqual(catalog['iph4tough'].family, 'rugged')
+
+        path = os.path.join(tempfile.mkdtemp(), 'extra.csv')
+        try:
+            with open(path, 'w') as f:
+                f.write('code,category,family,description\nSP99998,case,tough,test\n')
+            catalog.load(path)
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+        self.assertEqual(catalog['SP99998'].description, 'test')
+
+        catalog.remove('SP99999')
+        self.assertFalse('SP99999' in catalog)
+        self.assertFalse('SP99998' in spoke.CATALOG)
+
+
+class FormatterTests(unittest.TestCase):
+    def test_builtin_formatters(self):
+        formatters = spoke.FORMATTERS
+        self.assertEqual(formatters.format(date(2011, 11, 8)), '11/08/2011')
+        self.assertEqual(formatters.format(datetime(2011, 11, 8, 3, 50)), '11/08/2011')
+        self.assertEqual(formatters.format(decimal.Decimal('1E+2')), '100')
+        self.assertEqual(formatters.format(decimal.Decimal('12.50')), '12.50')
+        self.assertEqual(formatters.format(True), 'Yes')
+        self.assertEqual(formatters.format(False), 'No')
+        self.assertEqual(formatters.format(1500), '1500')
+        self.assertEqual(formatters.format(u'Zo\xeb'), u'Zo\xeb')
+        self.assertEqual(formatters.format(1.5), '1.5')
+
+        class Level(enum.IntEnum):
+            LOW = 1
+        self.assertEqual(formatters.format(Level.LOW), '1')
+
+    def test_register(self):
+        class Cents(int):
+            pass
+        class Money(object):
+            def __init__(self, cents):
+                self.cents = cents
+
+        formatters = spoke.FormatterRegistry()
+        formatters.register(int, str)
+        self.assertEqual(formatters.format(Cents(5)), '5')
+        formatters.register(Cents, lambda value: '%d cents' % value)
+        formatters.register(Money, lambda value: str(value.cents))
+        self.assertEqual(formatters.format(Cents(5)), '5 cents')
+        self.assertEqual(formatters.format(Money(250)), '250')
+
+    def test_order_date_in_requests(self):
+        transport = RecordingFauxTransport()
+        sp = spoke.Spoke(
+            Customer   = CUSTOMER_NAME,
+            Key        = CUSTOMER_KEY,
+            production = False,
+            transport  = transport,
+        )
+        params = new_order_params()
+        params['OrderInfo']['OrderDate'] = datetime(2011, 11, 8, 3, 50)
+        sp.new(**params)
+        self.assertTrue(b'<OrderDate>11/08/2011</OrderDate>' in transport.requests[0])
+
+
+class TenantPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.transport = RecordingFauxTransport()
+        self.pool = TenantPool(transport = self.transport, max_clients = 2)
+        for tenant in ('a', 'b', 'c'):
+            self.pool.register(tenant, Customer = tenant, Key = tenant + '-key')
+
+    def test_tenants_use_their_own_credentials(self):
+        self.pool.cancel('a', 1)
+        self.pool.cancel('b', 2)
+
+        self.assertTrue(b'<Customer>a</Customer>' in self.transport.requests[0])
+        self.assertTrue(b'<Key>b-key</Key>' in self.transport.requests[1])
+        self.assertTrue(self.pool.client('a').transport is self.pool.client('b').transport)
+
+
+    def test_clients_are_evicted_lru(self):
+        a = self.pool.client('a')
+        self.pool.client('b')
+        self.assertTrue(self.pool.client('a') is a)
+        self.pool.client('c')
+
+        self.assertTrue(self.pool.client('a') is a)
+        self.assertEqual(list(self.pool._tenants.keys()), ['c', 'a'])
+
+
+    def test_limits_survive_eviction(self):
+        self.pool.register('slow', Customer = 'slow', Key = 'k', rate = 20, share = 1)
+        entry = self.pool._tenant('slow')
+        self.pool.client('a')
+        self.pool.client('b')
+        self.assertFalse('slow' in self.pool._tenants)
+
+        again = self.pool._tenant('slow')
+        self.assertTrue(again.client is not entry.client)
+        self.assertTrue(again.bucket is entry.bucket)
+        self.assertTrue(again.slots is entry.slots)
+
+
+    def test_credentials_function_runs_unlocked(self):
+        release = threading.Event()
+        def credentials(tenant):
+            if tenant == 'blocked':
+                release.wait(5)
+            return dict(Customer = tenant, Key = 'k')
+
+        pool   = TenantPool(transport = self.transport, credentials = credentials)
+        thread = threading.Thread(target = pool.client, args = ('blocked',))
+        thread.start()
+        try:
+            time.sleep(0.05)
+            start = time.time()
+            pool.cancel('other', 1)
+            self.assertTrue(time.time() - start < 1)
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(sorted(pool._tenants), ['blocked', 'other'])
+
+
+    def test_credentials_function(self):
+        pool = TenantPool(transport = self.transport, credentials = lambda tenant: dict(Customer = tenant, Key = 'k'))
+        pool.cancel('lazy', 1)
+        self.assertTrue(b'<Customer>lazy</Customer>' in self.transport.requests[0])
+        self.assertRaises(KeyError, TenantPool(transport = self.transport).client, 'nobody')
+
+
+    def test_tenant_rate_limit(self):
+        self.pool.register('slow', Customer = 'slow', Key = 'k', rate = 20)
+        start = time.time()
+        for order_id in range(5):
+            self.pool.cancel('slow', order_id)
+        self.assertTrue(time.time() - start >= 0.15)
+
+
+    def test_tenant_share(self):
+        in_flight = []
+        peak      = []
+        lock      = threading.Lock()
+
+        class SlowTransport(RecordingFauxTransport):
+            def send(self, request):
+                with lock:
+                    in_flight.append(1)
+                    peak.append(len(in_flight))
+                time.sleep(0.02)
+                with lock:
+                    in_flight.pop()
+                return RecordingFauxTransport.send(self, request)
+
+        pool = TenantPool(transport = SlowTransport(), max_in_flight = 4)
+        pool.register('shared', Customer = 'c', Key = 'k', share = 2)
+        threads = [ threading.Thread(target = pool.cancel, args = ('shared', i)) for i in range(6) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(max(peak), 2)
+
+
+class LoadgenTests(unittest.TestCase):
+    def test_random_orders_are_valid(self):
+        sp = spoke.Spoke(
+            Customer       = CUSTOMER_NAME,
+            Key            = CUSTOMER_KEY,
+            production     = False,
+            transport      = RecordingFauxTransport(),
+            check_requests = True,
+        )
+        rng = random.Random(1)
+        for order_id in range(50):
+            sp.new(**loadgen.random_order(rng, order_id = order_id))
+
+
+    def test_run_reports(self):
+        class FlakyTransport(RecordingFauxTransport):
+            def send(self, request):
+                if len(self.requests) % 4 == 3:
+                    self.requests.append(None)
+                    raise IOError('flaky')
+                return RecordingFauxTransport.send(self, request)
+
+        sp = spoke.Spoke(
+            Customer   = CUSTOMER_NAME,
+            Key        = CUSTOMER_KEY,
+            production = False,
+            transport  = FlakyTransport(),
+        )
+        report = loadgen.run(sp, count = 40, concurrency = 1, seed = 3)
+
+        self.assertEqual(report.count, 40)
+        self.assertEqual(dict(report.errors), dict(OSError = 10))
+        self.assertTrue(report.percentile(50) <= report.percentile(99) <= report.percentile(100))
+        self.assertTrue(report.throughput > 0)
+        self.assertTrue('p95' in str(report))
+
+
+    def test_run_at_rate(self):
+        with FauxSpokeServer() as server:
+            sp = spoke.Spoke(
+                Customer   = CUSTOMER_NAME,
+                Key        = CUSTOMER_KEY,
+                production = False,
+                transport  = spoke.Transport(server.url),
+            )
+            report = loadgen.run(sp, count = 10, concurrency = 2, rate = 50)
+
+        self.assertEqual(report.count, 10)
+        self.assertEqual(len(server.requests), 10)
+        self.assertTrue(report.elapsed >= 0.18)
+
+
+class ReplayTests(unittest.TestCase):
+    def setUp(self):
+        self.dir  = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'traffic.cap')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def record(self, inner):
+        transport = replay.RecordingTransport(inner, self.path)
+        sp = spoke.Spoke(
+            Customer   = CUSTOMER_NAME,
+            Key        = CUSTOMER_KEY,
+            production = False,
+            transport  = transport,
+        )
+        return sp, transport
+
+    def test_record_and_replay(self):
+        sp, transport = self.record(RecordingFauxTransport())
+        sp.new(**new_order_params())
+        sp.cancel(2)
+        transport.close()
+
+        exchanges = list(replay.read_capture(self.path))
+        self.assertEqual([ e.request for e in exchanges ], transport.inner.requests)
+        self.assertFalse(any(e.failed for e in exchanges))
+
+        sp = spoke.Spoke(
+            Customer   = CUSTOMER_NAME,
+            Key        = CUSTOMER_KEY,
+            production = False,
+            transport  = replay.ReplayTransport(self.path, timing = 'fast'),
+        )
+        self.assertEqual(sp.cancel(2), dict(immc_id = 12345))
+        self.assertEqual(sp.cancel(2), dict(immc_id = 12345))
+        self.assertRaises(EOFError, sp.cancel, 2)
+
+
+    def test_captures_are_appended(self):
+        for _ in range(2):
+            sp, transport = self.record(FauxTransport())
+            sp.cancel(2)
+            transport.close()
+
+        self.assertEqual(len(list(replay.read_capture(self.path))), 2)
+
+
+    def test_failures_are_replayed(self):
+        class BrokenTransport(object):
+            def send(self, request):
+                time.sleep(0.05)
+                raise IOError('connection refused')
+
+        sp, transport = self.record(BrokenTransport())
+        self.assertRaises(IOError, sp.cancel, 2)
+        transport.close()
+
+        player = replay.ReplayTransport(self.path, loop = True)
+        for _ in range(2):
+            start = time.time()
+            self.assertRaises(IOError, player.send, b'')
+            self.assertTrue(time.time() - start >= 0.05)
+        self.assertEqual(player.requests, 2)
+
+
+class UpdateCacheTests(unittest.TestCase):
+    def client(self, cache):
+        self.transport = RecordingFauxTransport()
+        return spoke.Spoke(
+            Customer     = CUSTOMER_NAME,
+            Key          = CUSTOMER_KEY,
+            production   = False,
+            transport    = self.transport,
+            update_cache = cache,
+        )
+
+    def order_info(self, **overrides):
+        info = dict(new_order_params()['OrderInfo'], OrderDate = '11/08/2011')
+        info.update(overrides)
+        return info
+
+    def test_unchanged_updates_are_skipped(self):
+        sp = self.client(spoke.UpdateCache())
+
+        self.assertEqual(sp.update(OrderId = 1, OrderInfo = self.order_info()), dict(immc_id = 12345))
+        self.assertEqual(sp.update(OrderId = 1, OrderInfo = self.order_info()), dict(immc_id = 12345))
+        self.assertEqual(len(self.transport.requests), 1)
+
+        sp.update(OrderId = 1, OrderInfo = self.order_info(PostalCode = '54321'))
+        sp.update(OrderId = 2, OrderInfo = self.order_info(PostalCode = '54321'))
+        self.assertEqual(len(self.transport.requests), 3)
+
+
+    def test_new_and_cancel_maintain_cache(self):
+        sp = self.client(spoke.UpdateCache())
+
+        sp.new(**new_order_params(OrderInfo = self.order_info()))
+        sp.update(OrderId = 2, OrderInfo = self.order_info())
+        self.assertEqual(len(self.transport.requests), 1)
+
+        sp.cancel(2)
+        sp.update(OrderId = 2, OrderInfo = self.order_info())
+        self.assertEqual(len(self.transport.requests), 3)
+
+
+    def test_failed_updates_invalidate(self):
+        sp = self.client(spoke.UpdateCache())
+        sp.update(OrderId = 1, OrderInfo = self.order_info())
+
+        send = self.transport.send
+        def time_out(request):
+            send(request) # Spoke gets it, but the response never arrives
+            raise spoke.requests.Timeout()
+        self.transport.send = time_out
+        self.assertRaises(spoke.requests.Timeout, sp.update, OrderId = 1, OrderInfo = self.order_info(PostalCode = '54321'))
+        self.transport.send = send
+
+        sp.update(OrderId = 1, OrderInfo = self.order_info())
+        self.assertEqual(len(self.transport.requests), 3)
+
+
+    def test_cache_is_bounded(self):
+        cache = spoke.UpdateCache(max_size = 2)
+        sp = self.client(cache)
+        for order_id in (1, 2, 3):
+            sp.update(OrderId = order_id, OrderInfo = self.order_info())
+
+        self.assertEqual(cache.get(1), None)
+        sp.update(OrderId = 3, OrderInfo = self.order_info())
+        self.assertEqual(len(self.transport.requests), 3)
+
+
+    def test_disk_cache_survives_restarts(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'updates')
+            cache = spoke.DiskUpdateCache(path)
+            self.client(cache).update(OrderId = 1, OrderInfo = self.order_info())
+            cache.close()
+
+            cache = spoke.DiskUpdateCache(path)
+            self.client(cache).update(OrderId = 1, OrderInfo = self.order_info())
+            cache.close()
+            self.assertEqual(len(self.transport.requests), 0)
+        finally:
+            shutil.rmtree(directory)
+
+
+class HTTPClientTransportTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FauxSpokeServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_persistent_connection(self):
+        sp = spoke.Spoke(
+            Customer   = CUSTOMER_NAME,
+            Key        = CUSTOMER_KEY,
+            production = False,
+            transport  = spoke.HTTPClientTransport(self.server.url),
+        )
+        self.assertEqual(sp.new(**new_order_params()), dict(immc_id = 1))
+        self.assertEqual(sp.cancel(2), dict(immc_id = 2))
+
+        self.assertEqual(self.server.connections, 1)
+        self.assertTrue(b'<OrderId>2</OrderId>' in self.server.requests[1])
+
+
+    def test_warmup(self):
+        transport = spoke.HTTPClientTransport(self.server.url)
+        transport.warmup(2)
+        transport.send(b'<Request/>')
+        time.sleep(0.05)
+        self.assertEqual(self.server.connections, 2)
+        transport.close()
+
+
+    def test_no_retry_after_timeout(self):
+        transport = spoke.HTTPClientTransport(self.server.url, timeout = 0.1)
+        transport.send(b'<Request/>')
+
+        self.server.delay = 0.3
+        self.assertRaises(socket.timeout, transport.send, b'<Request/>')
+        time.sleep(0.4)
+        self.assertEqual(len(self.server.requests), 2)
+        transport.close()
+
+
+    def test_server_closed_idle_connection(self):
+        transport = spoke.HTTPClientTransport(self.server.url)
+        self.server.keepalive = False
+        transport.send(b'<Request/>')
+        time.sleep(0.05)
+
+        transport.send(b'<Request/>')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.connections, 2)
+        transport.close()
+
+
+    def test_retry_on_remote_disconnect(self):
+        transport = spoke.HTTPClientTransport(self.server.url)
+        transport.send(b'<Request/>')
+
+        self.server.hang_up = 1
+        transport.send(b'<Request/>')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.connections, 2)
+
+        self.server.hang_up = 1 # on a fresh connection, it's not retried
+        transport.close()
+        self.assertRaises(spoke.http_client.RemoteDisconnected, transport.send, b'<Request/>')
+        transport.close()
+
+
+    def test_retry_on_closed_idle_connection(self):
+        transport = spoke.HTTPClientTransport(self.server.url)
+        transport.send(b'<Request/>')
+        transport._idle[0].sock.shutdown(socket.SHUT_RDWR) # as if the server timed it out
+
+        transport.send(b'<Request/>')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.connections, 2)
+        transport.close()
+
+
+    def test_http_errors(self):
+        self.server.status = 503
+        transport = spoke.HTTPClientTransport(self.server.url)
+        self.assertRaises(spoke.requests.HTTPError, transport.send, b'<Request/>')
+
+
+    def test_transport_class(self):
+        sp = spoke.Spoke(
+            Customer   = CUSTOMER_NAME,
+            Key        = CUSTOMER_KEY,
+            production = True,
+            transport  = spoke.HTTPClientTransport,
+        )
+        self.assertTrue(isinstance(sp.transport, spoke.HTTPClientTransport))
+        self.assertEqual(sp.transport.url, spoke.PRODUCTION_URL)
+
+
+class AIMDTests(unittest.TestCase):
+    def test_additive_increase(self):
+        limiter = concurrency.AIMDLimiter(initial = 2, maximum = 4)
+        for _ in range(5):
+            limiter.release(limiter.acquire())
+        self.assertEqual(limiter.limit, 4)
+        for _ in range(10):
+            limiter.release(limiter.acquire())
+        self.assertEqual(limiter.limit, 4)
+
+
+    def test_multiplicative_decrease(self):
+        changes = []
+        limiter = concurrency.AIMDLimiter(initial = 16, on_change = changes.append)
+        first  = limiter.acquire()
+        second = limiter.acquire()
+        limiter.release(first, concurrency.OVERLOAD)
+        limiter.release(second, concurrency.OVERLOAD)
+        self.assertEqual(limiter.limit, 8)
+
+        limiter.release(limiter.acquire(), concurrency.OVERLOAD)
+        self.assertEqual(limiter.limit, 4)
+        self.assertEqual(changes, [8, 4])
+
+        limiter.release(limiter.acquire(), concurrency.ERROR)
+        self.assertEqual(limiter.limit, 4)
+
+
+    def test_slow_calls_are_overload(self):
+        limiter = concurrency.AIMDLimiter(initial = 8, latency_target = 0.5)
+        limiter.release(time.time() - 1)
+        self.assertEqual(limiter.limit, 4)
+
+
+    def test_classify(self):
+        response = spoke.requests.Response()
+        response.status_code = 503
+        self.assertEqual(concurrency.classify(spoke.requests.HTTPError(response = response)), concurrency.OVERLOAD)
+        response.status_code = 404
+        self.assertEqual(concurrency.classify(spoke.requests.HTTPError(response = response)), concurrency.ERROR)
+        self.assertEqual(concurrency.classify(spoke.requests.Timeout()), concurrency.OVERLOAD)
+        self.assertEqual(concurrency.classify(spoke.SpokeError('Rate limit exceeded')), concurrency.OVERLOAD)
+        self.assertEqual(concurrency.classify(spoke.SpokeDuplicateOrder('duplicate OrderId')), concurrency.ERROR)
+
+
+    def test_submit_all_backs_off(self):
+        lock      = threading.Lock()
+        in_flight = [0]
+
+        class CrowdedTransport(RecordingFauxTransport):
+            def send(self, request):
+                with lock:
+                    in_flight[0] += 1
+                    crowded = in_flight[0] > 3
+                try:
+                    time.sleep(0.005)
+                    if crowded:
+                        raise spoke.requests.Timeout()
+                    return RecordingFauxTransport.send(self, request)
+                finally:
+                    with lock:
+                        in_flight[0] -= 1
+
+        sp = spoke.Spoke(
+            Customer   = CUSTOMER_NAME,
+            Key        = CUSTOMER_KEY,
+            production = False,
+            transport  = CrowdedTransport(),
+        )
+        limiter = concurrency.AIMDLimiter(initial = 8, maximum = 16)
+        results = concurrency.submit_all(sp, [ new_order_params(OrderId = n) for n in range(200) ], limiter)
+
+        self.assertEqual(len(results), 200)
+        # the limit saws around the 3 calls the transport can take; how far
+        # above it gets depends on thread scheduling
+        self.assertTrue(limiter.limit < 8)
+        ok = [ r for r in results if isinstance(r, dict) ]
+        self.assertTrue(len(ok) > 100)
+
+
+class PrioritySchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.gate = threading.Event()
+        self.sent = []
+        gate, sent = self.gate, self.sent
+
+        class GatedClient(object):
+            def new(self, **kwargs):
+                gate.wait()
+                sent.append(kwargs['OrderId'])
+                return dict(immc_id = kwargs['OrderId'])
+
+        self.client = GatedClient()
+        self.now    = [1000000.0]
+
+    def scheduler(self, **kwargs):
+        scheduler = scheduler_module.PriorityScheduler(self.client, workers = 1, clock = lambda: self.now[0], **kwargs)
+        # the worker takes the first order straight away; hold it at the gate
+        scheduler.submit(OrderId = 'first', ShippingMethod = 'FirstClass')
+        time.sleep(0.05)
+        return scheduler
+
+    def finish(self, scheduler):
+        self.gate.set()
+        scheduler.close()
+        return self.sent[1:]
+
+    def test_urgent_orders_first(self):
+        scheduler = self.scheduler()
+        futures = [ scheduler.submit(OrderId = n, ShippingMethod = method)
+            for n, method in enumerate(['FirstClass', 'SecondDay', 'FirstClass', 'Overnight']) ]
+
+        self.assertEqual(self.finish(scheduler), [3, 1, 0, 2])
+        self.assertEqual(futures[3].result(), dict(immc_id = 3))
+
+
+    def test_aging(self):
+        scheduler = self.scheduler()
+        scheduler.submit(OrderId = 'old', ShippingMethod = 'FirstClass')
+        self.now[0] += 5 * 3600
+        scheduler.submit(OrderId = 'new', ShippingMethod = 'Overnight')
+
+        self.assertEqual(self.finish(scheduler), ['old', 'new'])
+
+
+    def test_deadlines_and_custom_key(self):
+        scheduler = self.scheduler(key = lambda order: order.get('Boost', 0), lead_time = 60)
+        scheduler.submit(OrderId = 'boosted', Boost = 3600)
+        scheduler.submit(OrderId = 'due', deadline = self.now[0] - 3000)
+        scheduler.submit(OrderId = 'plain')
+
+        self.assertEqual(self.finish(scheduler), ['boosted', 'due', 'plain'])
+
+
+    def test_errors_go_to_futures(self):
+        class FailingClient(object):
+            def new(self, **kwargs):
+                raise spoke.SpokeError('nope')
+
+        scheduler = scheduler_module.PriorityScheduler(FailingClient(), workers = 2)
+        future = scheduler.submit(OrderId = 1)
+        self.assertRaises(spoke.SpokeError, future.result, 1)
+        scheduler.close()
+        self.assertRaises(RuntimeError, scheduler.submit, OrderId = 2)
+
+
+class OrderFileTests(unittest.TestCase):
+    def setUp(self):
+        self.dir  = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'orders.jsonl')
+        with open(self.path, 'w') as f:
+            for n in range(103):
+                f.write(json.dumps(dict(OrderId = n, City = UNICODE_FAUX_CITY)) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_shards_cover_the_file(self):
+        with reader.OrderFile(self.path) as orders:
+            self.assertEqual(len(orders), 103)
+            shards = orders.shards(4)
+            read   = [ [ o['OrderId'] for o in orders.read(shard) ] for shard in shards ]
+
+        self.assertEqual(sum(read, []), list(range(103)))
+        self.assertEqual([ len(r) for r in read ], [25, 26, 26, 26])
+        self.assertEqual(read[0][0], 0)
+        self.assertEqual(shards[-1].end, os.path.getsize(self.path))
+
+
+    def test_index_is_reused(self):
+        with reader.OrderFile(self.path) as orders:
+            index = orders.index()
+        self.assertTrue(os.path.exists(self.path + '.idx'))
+
+        with reader.OrderFile(self.path) as orders:
+            orders._build_index = None # must not be called
+            self.assertEqual(orders.index(), index)
+
+
+    def test_resume_from_checkpoint(self):
+        checkpoints = os.path.join(self.dir, 'checkpoints')
+        os.mkdir(checkpoints)
+
+        with reader.OrderFile(self.path) as orders:
+            shard = orders.shards(2)[1]
+            seen  = []
+            for order in orders.read(shard, checkpoints, every = 10):
+                seen.append(order['OrderId'])
+                if len(seen) == 25:
+                    break # the job dies while processing order 75
+
+            resumed = [ o['OrderId'] for o in orders.read(shard, checkpoints, every = 10) ]
+            self.assertEqual(resumed[0], 71)
+            self.assertEqual(resumed[-1], 102)
+
+            self.assertEqual(list(orders.read(shard, checkpoints)), [])
+
+
+class ImagePreflightTests(unittest.TestCase):
+    def setUp(self):
+        self.server    = FauxSpokeServer().start()
+        self.preflight = preflight.ImagePreflight(max_workers = 4)
+
+    def tearDown(self):
+        self.preflight.close()
+        self.server.stop()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server.port, path)
+
+    def test_check_caches_results(self):
+        self.server.missing.add('/missing.jpg')
+        urls = [ self.url('/art.jpg'), self.url('/missing.jpg'), self.url('/art.jpg') ]
+
+        self.assertEqual(self.preflight.check(urls), {urls[0] : True, urls[1] : False})
+        self.assertEqual(self.preflight.check(urls), {urls[0] : True, urls[1] : False})
+        self.assertEqual(sorted(self.server.heads), ['/art.jpg', '/missing.jpg'])
+
+
+    def test_results_expire(self):
+        self.preflight.ttl = 0
+        self.preflight.check([self.url('/art.jpg')])
+        self.preflight.check([self.url('/art.jpg')])
+        self.assertEqual(len(self.server.heads), 2)
+
+
+    def test_network_errors_arent_cached(self):
+        self.server.stop()
+        url = self.url('/art.jpg')
+        self.assertEqual(self.preflight.check([url]), {url : False})
+
+        self.server.start()
+        self.assertEqual(self.preflight.check([url]), {url : True})
+
+
+    def test_new_orders_are_checked(self):
+        self.server.missing.add('/qc.jpg')
+        transport = RecordingFauxTransport()
+        sp = spoke.Spoke(
+            Customer   = CUSTOMER_NAME,
+            Key        = CUSTOMER_KEY,
+            production = False,
+            transport  = transport,
+            preflight  = self.preflight,
+        )
+        params = new_order_params()
+        params['Cases'][0]['PrintImage']['Url'] = self.url('/art.jpg')
+        sp.new(**params)
+
+        params = new_order_params(PackSlip = spoke.Image(ImageType = 'jpg', Url = self.url('/slip.jpg')))
+        params['Cases'][0]['PrintImage']['Url'] = self.url('/art.jpg')
+        params['Cases'][0]['QcImage'] = dict(ImageType = 'jpg', Url = self.url('/qc.jpg'))
+        self.assertRaises(spoke.ValidationError, sp.new, **params)
+
+        self.assertEqual(len(transport.requests), 1)
+        self.assertEqual(sorted(self.server.heads), ['/art.jpg', '/qc.jpg', '/slip.jpg'])
+
+
+class AgentTests(unittest.TestCase):
+    def setUp(self):
+        self.dir       = tempfile.mkdtemp()
+        self.path      = os.path.join(self.dir, 'agent.sock')
+        self.transport = RecordingFauxTransport()
+        sp = spoke.Spoke(
+            Customer   = CUSTOMER_NAME,
+            Key        = CUSTOMER_KEY,
+            production = False,
+            transport  = self.transport,
+        )
+        self.agent = agent.Agent(sp, self.path).start()
+
+    def tearDown(self):
+        self.agent.stop()
+        shutil.rmtree(self.dir)
+
+    def order(self, order_id = 2):
+        params = new_order_params(OrderId = order_id)
+        params['OrderInfo']['OrderDate'] = '11/08/2011'
+        return params
+
+    def test_submissions(self):
+        client = agent.AgentClient(self.path)
+        self.assertEqual(client.new(**self.order()), dict(immc_id = 12345))
+        self.assertEqual(client.update(OrderId = 2, OrderInfo = self.order()['OrderInfo']), dict(immc_id = 12345))
+        self.assertEqual(client.cancel(2), dict(immc_id = 12345))
+        client.close()
+
+        self.assertEqual(len(self.transport.requests), 3)
+        self.assertTrue(b'<RequestType>Cancel</RequestType>' in self.transport.requests[2])
+
+
+    def test_only_replaces_sockets(self):
+        path = os.path.join(self.dir, 'orders.csv')
+        with open(path, 'w') as f:
+            f.write('keep me')
+        self.assertRaises(OSError, agent.Agent(self.agent.client, path).start)
+        with open(path) as f:
+            self.assertEqual(f.read(), 'keep me')
+
+        stale = os.path.join(self.dir, 'stale.sock')
+        sock  = socket.socket(socket.AF_UNIX)
+        sock.bind(stale) # left behind, as if by a crashed agent
+        sock.close()
+        agent.Agent(self.agent.client, stale).start().stop()
+
+
+    def test_errors(self):
+        client = agent.AgentClient(self.path)
+        self.assertRaises(spoke.ValidationError, client.new, OrderId = 2)
+        self.assertRaises(agent.AgentError, client._call, 'explode', {})
+        # the connection is still usable
+        self.assertEqual(client.cancel(2), dict(immc_id = 12345))
+        client.close()
+
+
+    def test_concurrent_producers(self):
+        results = []
+        def produce(order_id):
+            client = agent.AgentClient(self.path)
+            results.append(client.new(**self.order(order_id)))
+            client.close()
+
+        threads = [ threading.Thread(target = produce, args = (n,)) for n in range(8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 8)
+        self.assertEqual(len(self.transport.requests), 8)
+
+
+class DecodeTests(unittest.TestCase):
+    def setUp(self):
+        self.transport = RecordingFauxTransport()
+        self.sp = spoke.Spoke(
+            Customer   = CUSTOMER_NAME,
+            Key        = CUSTOMER_KEY,
+            production = False,
+            transport  = self.transport,
+        )
+
+    def order(self):
+        params = loadgen.random_order(random.Random(7), order_id = 2)
+        params['PackSlip'] = spoke.Image(ImageType = 'png', Url = 'http://threadless.com/slip.png')
+        params['Comments'] = [spoke.Comment(Type = 'Printer', CommentText = 'Handle with care')]
+        params['OrderInfo']['Prices'] = spoke.Prices(TaxCents = 10, CurrencySymbol = '$')
+        params['Cases'][0]['Prices'] = dict(RetailCents = 2500)
+        return params
+
+    def test_round_trip(self):
+        self.sp.new(**self.order())
+        request = decode.decode(self.transport.requests[0])
+        self.assertEqual(request.RequestType, 'New')
+        self.assertEqual(request.Customer, CUSTOMER_NAME)
+
+        order = request.Order
+        self.assertTrue(isinstance(order['OrderInfo'], spoke.OrderInfo))
+        self.assertTrue(isinstance(order['OrderInfo'].Prices, spoke.Prices))
+        self.assertTrue(isinstance(order['PackSlip'], spoke.Image))
+        self.assertTrue(isinstance(order['Comments'][0], spoke.Comment))
+        self.assertTrue(isinstance(order['Cases'][0], spoke.Case))
+        self.assertTrue(isinstance(order['Cases'][0].PrintImage, spoke.Image))
+        self.assertEqual(order['Cases'][0].Prices, dict(RetailCents = '2500'))
+        self.assertTrue(order['ShippingMethod'] in spoke.SHIPPING_METHODS)
+
+        # re-sending the decoded order produces the same request
+        self.sp.new(**order)
+        self.assertEqual(self.transport.requests[1], self.transport.requests[0])
+
+    def test_validate(self):
+        self.sp.new(**self.order())
+        request = self.transport.requests[0].replace(b'<Type>Printer</Type>', b'<Type>Nope</Type>')
+        decode.decode(request)
+        self.assertRaises(spoke.ValidationError, decode.decode, request, validate = True)
+
+    def test_iterdecode(self):
+        self.sp.new(**self.order())
+        self.sp.update(OrderId = 2, OrderInfo = self.order()['OrderInfo'])
+        self.sp.cancel(2)
+        archive = b'<Archive>' + b''.join(self.transport.requests) + b'</Archive>'
+
+        requests = list(decode.iterdecode(io.BytesIO(archive)))
+        self.assertEqual([ r.RequestType for r in requests ], ['New', 'Update', 'Cancel'])
+        self.assertEqual(requests[2].Order, dict(OrderId = '2'))
+
+
+class FlightRecorderTests(unittest.TestCase):
+    def setUp(self):
+        self.dump_dir  = tempfile.mkdtemp()
+        self.transport = RecordingFauxTransport()
+        self.recorder  = recorder.FlightRecorder(size = 4, body_limit = 16, error_rate = 0.5, window = 4, dump_dir = self.dump_dir)
+        self.sp = spoke.Spoke(
+            Customer   = CUSTOMER_NAME,
+            Key        = CUSTOMER_KEY,
+            production = False,
+            transport  = self.transport,
+            recorder   = self.recorder,
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.dump_dir)
+
+    def test_records_calls(self):
+        self.sp.new(**new_order_params())
+        self.sp.cancel(2)
+
+        new, cancel = self.recorder.records()
+        self.assertEqual((new['request_type'], new['order_id'], new['outcome']), ('New', 2, 'ok'))
+        self.assertEqual(new['request_size'], len(self.transport.requests[0]))
+        self.assertEqual(len(new['request']), 16)
+        self.assertTrue(new['serialize'] >= 0 and new['send'] >= 0 and new['parse'] >= 0)
+        self.assertEqual(cancel['request_type'], 'Cancel')
+
+    def test_credentials_are_redacted(self):
+        self.recorder.body_limit = 512
+        self.sp.cancel(2)
+
+        request = self.recorder.records()[0]['request']
+        self.assertFalse(CUSTOMER_KEY in request)
+        self.assertFalse(CUSTOMER_NAME in request)
+        self.assertTrue('<Key>redacted</Key>' in request)
+        self.assertTrue('<OrderId>2</OrderId>' in request)
+
+    def test_dumps_are_private(self):
+        path = os.path.join(self.dump_dir, 'calls.jsonl')
+        self.recorder.dump(path)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        self.assertRaises(ValueError, recorder.FlightRecorder, error_rate = 0.5)
+
+    def test_ring_keeps_the_latest(self):
+        for order_id in range(10):
+            self.sp.cancel(order_id)
+        self.assertEqual([ r['order_id'] for r in self.recorder.records() ], [6, 7, 8, 9])
+
+    def test_failures_and_automatic_dump(self):
+        self.sp.cancel(1)
+        self.sp.cancel(2)
+        self.transport.send = lambda request: b'<ResponseFailure><result>Failure</result><message>Bad</message></ResponseFailure>'
+        for order_id in (3, 4, 5):
+            self.assertRaises(spoke.SpokeError, self.sp.cancel, order_id)
+
+        record = self.recorder.records()[-1]
+        self.assertEqual((record['outcome'], record['error']), ('SpokeError', 'Bad'))
+        self.assertEqual(os.listdir(self.dump_dir), [os.path.basename(self.recorder.last_dump)])
+        with open(self.recorder.last_dump) as f:
+            self.assertEqual([ json.loads(line)['order_id'] for line in f ], [2, 3, 4, 5])
+
+    def test_transport_errors(self):
+        def fail(request):
+            raise RuntimeError('unreachable')
+        self.transport.send = fail
+        self.assertRaises(RuntimeError, self.sp.cancel, 1)
+
+        record = self.recorder.records()[0]
+        self.assertEqual((record['outcome'], record['response'], record['parse']), ('RuntimeError', None, None))
+        self.assertTrue(record['send'] is not None)
+
+
+class OrderedSubmitterTests(unittest.TestCase):
+    def setUp(self):
+        self.lock      = threading.Lock()
+        self.sent      = []
+        self.in_flight = [0, 0] # current, most
+        self.gate      = threading.Event()
+        self.gate.set()
+        test = self
+
+        class SlowTransport(RecordingFauxTransport):
+            def send(self, request):
+                test.gate.wait()
+                with test.lock:
+                    test.in_flight[0] += 1
+                    test.in_flight[1] = max(test.in_flight)
+                time.sleep(0.01)
+                order    = decode.decode(request)
+                with test.lock:
+                    test.in_flight[0] -= 1
+                    test.sent.append((order.Order['OrderId'], order.RequestType))
+                return RecordingFauxTransport.send(self, request)
+
+        self.sp = spoke.Spoke(
+            Customer   = CUSTOMER_NAME,
+            Key        = CUSTOMER_KEY,
+            production = False,
+            transport  = SlowTransport(),
+        )
+        self.submitter = ordering.OrderedSubmitter(self.sp, workers = 8)
+
+    def tearDown(self):
+        self.gate.set()
+        self.submitter.close()
+
+    def test_same_order_runs_in_order(self):
+        futures = []
+        for order_id in range(4):
+            futures.append(self.submitter.new(**new_order_params(OrderId = order_id)))
+            futures.append(self.submitter.cancel(order_id))
+        for future in futures:
+            self.assertEqual(future.result(), dict(immc_id = 12345))
+
+        for order_id in range(4):
+            calls = [ request_type for sent_id, request_type in self.sent if sent_id == str(order_id) ]
+            self.assertEqual(calls, ['New', 'Cancel'])
+        # different orders ran in parallel
+        self.assertTrue(self.in_flight[1] > 1)
+
+    def test_cancel_drops_pending_updates(self):
+        self.gate.clear()
+        first   = self.submitter.new(**new_order_params())
+        updates = [ self.submitter.update(OrderId = 2, OrderInfo = new_order_params()['OrderInfo']) for _ in range(2) ]
+        cancel  = self.submitter.cancel(2)
+        self.gate.set()
+
+        self.assertEqual(cancel.result(), dict(immc_id = 12345))
+        self.assertTrue(first.done())
+        self.assertTrue(all( future.cancelled() for future in updates ))
+        self.assertEqual(self.submitter.dropped, 2)
+        self.assertEqual(self.sent, [('2', 'New'), ('2', 'Cancel')])
+
+    def test_later_update_supersedes_pending_one(self):
+        self.gate.clear()
+        self.submitter.new(**new_order_params())
+        stale  = self.submitter.update(OrderId = 2, OrderInfo = new_order_params()['OrderInfo'])
+        latest = self.submitter.update(OrderId = 2, OrderInfo = new_order_params()['OrderInfo'])
+        self.gate.set()
+
+        self.assertEqual(latest.result(), dict(immc_id = 12345))
+        self.assertTrue(stale.cancelled())
+        self.submitter.close()
+        self.assertEqual(len(self.submitter), 0)
+
+    def test_errors_reach_the_future(self):
+        future = self.submitter.new(OrderId = 2)
+        self.assertRaises(spoke.ValidationError, future.result)
+
+
+class PipelineTests(unittest.TestCase):
+    def setUp(self):
+        self.transport = RecordingFauxTransport()
+        self.sp = spoke.Spoke(
+            Customer   = CUSTOMER_NAME,
+            Key        = CUSTOMER_KEY,
+            production = False,
+            transport  = self.transport,
+        )
+
+    def orders(self, count):
+        rng = random.Random(5)
+        return [ loadgen.random_order(rng, order_id = n) for n in range(count) ]
+
+    def test_requests_match_the_client(self):
+        for order in self.orders(20):
+            self.sp.new(**order)
+        direct = sorted(self.transport.requests)
+        del self.transport.requests[:]
+
+        stages  = pipeline.Pipeline(self.sp, processes = 2, senders = 4, queue_size = 4)
+        results = stages.run(self.orders(20))
+        self.assertEqual(results, [dict(immc_id = 12345)] * 20)
+        self.assertEqual(sorted(self.transport.requests), direct)
+
+        stats = stages.stats()
+        self.assertEqual(stats['prepare']['completed'], 20)
+        self.assertEqual(stats['send']['completed'], 20)
+        self.assertEqual(stats['send']['queue_depth'], 0)
+        self.assertTrue(stats['send']['throughput'] > 0)
+
+    def test_workers_share_runtime_state(self):
+        orders = self.orders(2)
+        orders[0]['Cases'][0]['CaseType'] = 'PIPE1'
+        backend = spoke.XML_BACKEND
+        spoke.CATALOG.add('PIPE1', category = 'case')
+        spoke.FORMATTERS.register(str, str.upper)
+        try:
+            spoke.XML_BACKEND = spoke.xml_backend('etree')
+            context = multiprocessing.get_context('spawn')
+            results = pipeline.Pipeline(self.sp, processes = 1, senders = 1, context = context).run(orders)
+        finally:
+            spoke.XML_BACKEND = backend
+            spoke.FORMATTERS.register(str, spoke.passthrough)
+            spoke.CATALOG.remove('PIPE1')
+
+        self.assertEqual(results, [dict(immc_id = 12345)] * 2)
+        self.assertTrue(any( b'<CaseType>PIPE1</CaseType>' in request for request in self.transport.requests ))
+        self.assertTrue(all( b'<RequestType>NEW</RequestType>' in request for request in self.transport.requests ))
+
+    def test_errors(self):
+        orders  = self.orders(3)
+        orders[1]['ShippingMethod'] = 'Teleport'
+        stages  = pipeline.Pipeline(self.sp, processes = 1, senders = 2)
+        results = stages.run(orders)
+
+        self.assertTrue(isinstance(results[1], spoke.ValidationError))
+        self.assertEqual(results[2], dict(immc_id = 12345))
+        self.assertEqual(stages.stats()['prepare']['errors'], 1)
+
+    def test_update_cache_is_invalidated(self):
+        self.sp.update_cache = spoke.UpdateCache()
+        info = dict(new_order_params()['OrderInfo'], OrderDate = '11/08/2011')
+        self.sp.update(OrderId = 1, OrderInfo = info)
+
+        changed = dict(info, PostalCode = '54321')
+        pipeline.Pipeline(self.sp, method = 'update', processes = 1).run([dict(OrderId = 1, OrderInfo = changed)])
+        self.sp.update(OrderId = 1, OrderInfo = info)
+        self.assertEqual(len(self.transport.requests), 3)
+
+    def test_cancel(self):
+        results = pipeline.Pipeline(self.sp, method = 'cancel', processes = 1).run([ dict(OrderId = n) for n in range(3) ])
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all( b'<RequestType>Cancel</RequestType>' in request for request in self.transport.requests ))
+
+
+class CircuitBreakerTests(unittest.TestCase):
+    def setUp(self):
+        self.now     = [1000.0]
+        self.changes = []
+        self.breaker = breaker.CircuitBreaker(
+            failure_rate  = 0.5,
+            window        = 4,
+            min_calls     = 4,
+            reset_timeout = 30,
+            probes        = 2,
+            on_change     = lambda old, new: self.changes.append((old, new)),
+            clock         = lambda: self.now[0],
+        )
+
+    def fail(self):
+        raise spoke.requests.Timeout()
+
+    def raise_spoke_error(self):
+        raise spoke.SpokeError('Invalid address')
+
+    def trip(self):
+        self.breaker.call(lambda: 'ok')
+        self.breaker.call(lambda: 'ok')
+        self.assertRaises(spoke.requests.Timeout, self.breaker.call, self.fail)
+        self.assertEqual(self.breaker.state, breaker.CLOSED)
+        self.assertRaises(spoke.requests.Timeout, self.breaker.call, self.fail)
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+
+    def test_opens_and_fails_fast(self):
+        self.trip()
+        calls = []
+        self.assertRaises(breaker.CircuitOpen, self.breaker.call, calls.append, 1)
+        self.assertEqual(calls, [])
+        self.assertEqual(self.changes, [(breaker.CLOSED, breaker.OPEN)])
+        self.assertFalse(self.breaker.wait(0.01))
+
+    def test_other_errors_dont_count(self):
+        for _ in range(4):
+            self.assertRaises(spoke.SpokeError, self.breaker.call, self.raise_spoke_error)
+        self.assertEqual(self.breaker.state, breaker.CLOSED)
+
+    def test_probes_close_the_circuit(self):
+        self.trip()
+        self.now[0] += 30
+        self.assertEqual(self.breaker.state, breaker.HALF_OPEN)
+        self.assertTrue(self.breaker.wait(0))
+
+        # only probes calls are let through at once
+        gate    = threading.Event()
+        results = []
+        probes  = [ threading.Thread(target = lambda: results.append(self.breaker.call(gate.wait, 5))) for _ in range(2) ]
+        for probe in probes:
+            probe.start()
+        time.sleep(0.05)
+        self.assertRaises(breaker.CircuitOpen, self.breaker.call, lambda: 'ok')
+        gate.set()
+        for probe in probes:
+            probe.join()
+
+        self.assertEqual(self.breaker.state, breaker.CLOSED)
+        self.assertEqual(self.changes, [
+            (breaker.CLOSED, breaker.OPEN), (breaker.OPEN, breaker.HALF_OPEN), (breaker.HALF_OPEN, breaker.CLOSED),
+        ])
+
+    def test_failed_probe_reopens(self):
+        self.trip()
+        self.now[0] += 30
+        self.assertRaises(spoke.requests.Timeout, self.breaker.call, self.fail)
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+
+    def test_slow_calls_count_as_failures(self):
+        self.breaker.slow_call = 0.01
+        for _ in range(4):
+            self.breaker.call(time.sleep, 0.02)
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+
+    def test_transport_spools(self):
+        spool = []
+        class DownTransport(object):
+            def send(self, request):
+                raise spoke.requests.ConnectionError()
+        transport = breaker.BreakerTransport(DownTransport(), self.breaker, spool = spool.append)
+        sp = spoke.Spoke(
+            Customer   = CUSTOMER_NAME,
+            Key        = CUSTOMER_KEY,
+            production = False,
+            transport  = transport,
+        )
+        for order_id in range(4):
+            self.assertRaises(spoke.requests.ConnectionError, sp.cancel, order_id)
+        self.assertRaises(breaker.Spooled, sp.cancel, 5)
+        self.assertEqual(len(spool), 1)
+        self.assertEqual(decode.decode(spool[0]).Order, dict(OrderId = '5'))
+
+
+class XMLBackendTests(unittest.TestCase):
+    def setUp(self):
+        self.saved     = spoke.XML_BACKEND
+        self.transport = RecordingFauxTransport()
+        self.sp = spoke.Spoke(
+            Customer       = CUSTOMER_NAME,
+            Key            = CUSTOMER_KEY,
+            production     = False,
+            transport      = self.transport,
+            check_requests = True,
+        )
+
+    def tearDown(self):
+        spoke.XML_BACKEND = self.saved
+
+    def send_with(self, name, orders):
+        spoke.XML_BACKEND = spoke.xml_backend(name)
+        del self.transport.requests[:]
+        for order in orders:
+            self.assertEqual(self.sp.new(**order), dict(immc_id = 12345))
+        return list(self.transport.requests)
+
+    def orders(self):
+        rng    = random.Random(11)
+        orders = [ loadgen.random_order(rng, order_id = n) for n in range(20) ]
+        orders[0]['OrderInfo']['Address2'] = ''
+        orders[0]['OrderInfo']['GiftMessage'] = u'Line one\r\nLine <two> & "three"'
+        orders[0]['Comments'] = [dict(Type = 'Printer', CommentText = u'Zoë')]
+        return orders
+
+    def test_backends_produce_the_same_requests(self):
+        self.assertEqual(self.send_with('etree', self.orders()), self.send_with('lxml', self.orders()))
+
+    def test_backends_decode_the_same(self):
+        requests = self.send_with('lxml', self.orders())
+        decoded  = {}
+        for name in ('lxml', 'etree'):
+            spoke.XML_BACKEND = spoke.xml_backend(name)
+            decoded[name] = [ decode.decode(request).Order['OrderInfo'].__dict__ for request in requests ]
+        self.assertEqual(decoded['lxml'], decoded['etree'])
+        self.assertEqual(decoded['etree'][0]['GiftMessage'], u'Line one\r\nLine <two> & "three"')
+
+    def test_check_requests_needs_lxml(self):
+        saved = dict( (name, module) for name, module in sys.modules.items() if name == 'lxml' or name.startswith('lxml.') )
+        sys.modules['lxml'] = None # blocks importing it
+        try:
+            with self.assertRaises(ImportError) as raised:
+                spoke.Spoke(
+                    Customer       = CUSTOMER_NAME,
+                    Key            = CUSTOMER_KEY,
+                    production     = False,
+                    transport      = self.transport,
+                    check_requests = True,
+                )
+            self.assertTrue('Python-Spoke[lxml]' in str(raised.exception))
+        finally:
+            del sys.modules['lxml']
+            sys.modules.update(saved)
+
+    def test_errors_with_etree(self):
+        spoke.XML_BACKEND = spoke.xml_backend('etree')
+        self.transport.send = lambda request: b'<ResponseFailure><result>Failure</result><message>Duplicate OrderId</message></ResponseFailure>'
+        self.assertRaises(spoke.SpokeDuplicateOrder, self.sp.cancel, 2)
+
+
+class OrderTemplateTests(unittest.TestCase):
+    def setUp(self):
+        self.transport = RecordingFauxTransport()
+        self.sp = spoke.Spoke(
+            Customer   = CUSTOMER_NAME,
+            Key        = CUSTOMER_KEY,
+            production = False,
+            transport  = self.transport,
+        )
+
+    def defaults(self):
+        return dict(
+            ShippingAccount  = 'shop-account',
+            ShippingMethodId = '12',
+            PackSlip         = spoke.Image(ImageType = 'png', Url = 'http://threadless.com/slip.png'),
+            OrderInfo        = dict(
+                Prices             = spoke.Prices(DisplayOnPackingSlip = 'Yes', CurrencySymbol = '$'),
+                PackSlipCustomInfo = spoke.PackSlipCustomInfo(Text1 = 'Thanks!'),
+            ),
+        )
+
+    def order(self, **overrides):
+        params = new_order_params(**overrides)
+        del params['ShippingMethod']
+        params['OrderInfo']['OrderDate'] = '11/08/2011'
+        return params
+
+    def test_same_request_as_new(self):
+        template = self.sp.template(**self.defaults())
+        template.new(**self.order())
+
+        # defaults come first, as the template merges them
+        params = self.defaults()
+        order  = self.order()
+        order['OrderInfo'] = dict(params.pop('OrderInfo'), **order['OrderInfo'])
+        params.update(order)
+        self.sp.new(**params)
+
+        templated, direct = self.transport.requests
+        self.assertEqual(templated, direct)
+        self.assertTrue(b'<Text1>Thanks!</Text1>' in templated)
+
+    def test_overrides(self):
+        template = self.sp.template(**self.defaults())
+        order    = self.order()
+        order['OrderInfo']['Prices'] = spoke.Prices(DisplayOnPackingSlip = 'No')
+        template.new(PackSlip = dict(ImageType = 'jpg', Url = 'http://threadless.com/other.jpg'), **order)
+        template.new(validate = False, **self.order(OrderId = 3))
+
+        overridden, trusted = self.transport.requests
+        self.assertTrue(b'other.jpg' in overridden and b'slip.png' not in overridden)
+        self.assertTrue(b'<DisplayOnPackingSlip>No</DisplayOnPackingSlip>' in overridden)
+        self.assertTrue(b'slip.png' in trusted and b'Thanks!' in trusted)
+
+    def test_backend_replaced(self):
+        saved = spoke.XML_BACKEND
+        try:
+            spoke.XML_BACKEND = spoke.xml_backend('lxml')
+            template = self.sp.template(**self.defaults())
+            template.new(**self.order())
+            spoke.XML_BACKEND = spoke.xml_backend('etree')
+            template.new(**self.order())
+        finally:
+            spoke.XML_BACKEND = saved
+
+        with_lxml, with_etree = self.transport.requests
+        self.assertEqual(with_lxml, with_etree)
+
+    def test_validation(self):
+        self.assertRaises(spoke.ValidationError, self.sp.template, Cases = [])
+        self.assertRaises(spoke.ValidationError, self.sp.template, OrderInfo = dict(Prices = dict(DisplayOnPackingSlip = 'Maybe')))
+        template = self.sp.template(**self.defaults())
+        self.assertRaises(spoke.ValidationError, template.new, OrderId = 2, Cases = self.order()['Cases'])